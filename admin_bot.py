@@ -1,18 +1,23 @@
 #admin_bot.py
+import asyncio
 import logging
 import os
 import subprocess
 import time
-import requests
+import aiohttp
 import json
 import re
 from dotenv import load_dotenv
 from telethon import TelegramClient, events, Button
 import psutil  # Add psutil to manage subprocesses
 
-# Load environment variables
+# Load environment variables before importing the bot's modules, which read their settings at import time
 load_dotenv()
 
+from metrics import parse as parse_metrics
+from supervisor import ProcessSupervisor
+from supplemental_store import SupplementalStore
+
 # Variables used
 admin_api_id = os.getenv('ADMIN_API_ID')
 admin_api_hash = os.getenv('ADMIN_API_HASH')
@@ -27,6 +32,11 @@ client = TelegramClient('admin_bot', admin_api_id, admin_api_hash)
 client.start(bot_token=admin_bot_token)
 
 MAIN_BOT_SCRIPT = 'main.py'
+MAIN_BOT_URL = os.getenv('MAIN_BOT_URL', 'http://127.0.0.1:5001')
+# Sent with supplemental changes; must match the main bot's ADMIN_API_TOKEN
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN')
+# A first start without a persisted index has to sync all of Intercom before it is ready
+BOT_STARTUP_TIMEOUT = float(os.getenv('BOT_STARTUP_TIMEOUT', '900'))
 
 # Setup logging
 log_capture = []
@@ -48,10 +58,11 @@ class LogCaptureHandler(logging.Handler):
             r"Total records received from supplemental: \d+",
             r"Total valid documents: \d+",
             r"Total invalid documents: \d+",
-            r"Total embeddings generated: \d+",
+            r"Total records added: \d+, updated: \d+, deleted: \d+, unchanged: \d+",
             "Vector store successfully rebuilt.",
             r"Connection to \d+\.\d+\.\d+\.\d+:\d+/TcpFull complete!",
             "Telegram client connected.",
+            r"Startup complete: .*",
             "Bot started."
         ]
         
@@ -81,6 +92,11 @@ stats = {
     "articles_pulled": 0
 }
 
+def record_restart():
+    stats["last_restart"] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+supervisor = ProcessSupervisor(['python3', MAIN_BOT_SCRIPT], f"{MAIN_BOT_URL}/readyz", on_restart=record_restart)
+
 article_deletion_state = {}
 add_info_state = {}
 
@@ -94,7 +110,9 @@ async def admin_command(event):
         "🔄 <b>Reboot</b>:\nRestart the main bot. Useful if the responses start getting weird.\n\n"
         "💾 <b>Download DB</b>:\nDownload the database. Downloads an info.json file and shares it in this chat. Contains all intercom articles currently being used by the AI chat bot.\n\n"
         "🗑️ <b>Delete Article</b>:\nDelete an article from Intercom, works for both draft and live articles. You can find the article ID from the article's URL and grabbing the string of numbers from it. Just respond to the bot after clicking 'Delete Article' with the correct Article ID and it will be deleted.\n\n"
-        "➕ <b>Add Info</b>:\nAdd a new question and answer to the supplemental database."
+        "➕ <b>Add Info</b>:\nAdd a new question and answer to the supplemental database.\n\n"
+        "🔁 <b>Rebuild KB</b>:\nPull the latest Intercom articles into the knowledge base without restarting. The bot keeps answering while it runs.\n\n"
+        "📊 <b>Stats</b>:\nShow query counts, latency, cache hit rates and knowledge base size from the main bot's metrics."
     )
 
     await event.respond(message, parse_mode='html')
@@ -102,7 +120,8 @@ async def admin_command(event):
     buttons = [
         [Button.inline("🚀 Start", b"start_bot"), Button.inline("🔄 Reboot", b"reboot_bot")],
         [Button.inline("💾 Download DB", b"download_db"), Button.inline("🗑️ Delete Article", b"delete_article")],
-        [Button.inline("➕ Add Info", b"add_info")]
+        [Button.inline("➕ Add Info", b"add_info"), Button.inline("🔁 Rebuild KB", b"rebuild_kb")],
+        [Button.inline("📊 Stats", b"show_stats")]
     ]
 
     await event.respond("**Choose an action:**", buttons=buttons)
@@ -124,39 +143,42 @@ async def callback_handler(event):
         await delete_article_prompt(event)
     elif data == "add_info":
         await add_info_prompt(event)
+    elif data == "rebuild_kb":
+        await rebuild_knowledge_base(event)
+    elif data == "show_stats":
+        await show_stats(event)
 
 async def start_bot(event):
     logging.info("Starting the bot...")
+    if supervisor.is_running():
+        await event.respond(f"The bot is already running ({await supervisor.refresh_state()}).")
+        return
     await event.respond("Starting the bot...")
 
+    log_capture.clear()
     start_time = time.time()
-    process = subprocess.Popen(['python3', MAIN_BOT_SCRIPT], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-
-    while True:
-        line = process.stdout.readline()
-        if not line:
-            break
-        logging.info(line.strip())
-        if "Running on http://0.0.0.0:5001 (CTRL + C to quit)" in line:
-            break
-
-    end_time = time.time()
-    elapsed_time = end_time - start_time
+    await supervisor.start()
+    ready = await supervisor.wait_ready(BOT_STARTUP_TIMEOUT)
+    elapsed_time = time.time() - start_time
 
     # Capture logs and send to chat
     log_messages = "\n".join(log_capture)
     if log_messages:
         await event.respond(log_messages)
 
+    if not ready:
+        await event.respond(f"Bot did not become ready within {elapsed_time:.0f} seconds (state: {supervisor.state}).")
+        logging.error(f"Bot did not become ready within {elapsed_time:.0f} seconds.")
+        return
     await event.respond(f"Bot started in {elapsed_time:.2f} seconds.")
     logging.info(f"Bot started in {elapsed_time:.2f} seconds.")
 
 def is_bot_running():
-    """Check if the bot is running by looking for specific log entries or process checks."""
-    return True  # Placeholder: Replace with actual check
+    """Check if the supervised bot process is alive."""
+    return supervisor.is_running()
 
 def stop_all_subprocesses():
-    """Stop all subprocesses associated with the bot."""
+    """Stop stray bot processes that were not started by the supervisor."""
     logging.info("Stopping all subprocesses...")
     subprocess.run(['pkill', '-f', MAIN_BOT_SCRIPT])
     # Add any other subprocesses that need to be stopped here
@@ -166,6 +188,7 @@ def stop_all_subprocesses():
 async def stop_bot(event):
     logging.info("Stopping the bot...")
     await event.respond("Stopping the bot...")
+    await supervisor.stop()
     stop_all_subprocesses()
     await event.respond("Bot stopped.")
 
@@ -174,6 +197,7 @@ async def reboot_bot(event):
     await event.respond("Rebooting the bot...")
 
     # Stop the bot and all related subprocesses
+    await supervisor.stop()
     stop_all_subprocesses()
 
     # Ensure all instances of main.py are terminated
@@ -184,22 +208,108 @@ async def reboot_bot(event):
 
     # Start the bot
     start_time = time.time()
-    process = subprocess.Popen(['python3', MAIN_BOT_SCRIPT], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    await supervisor.start()
+    ready = await supervisor.wait_ready(BOT_STARTUP_TIMEOUT)
+    elapsed_time = time.time() - start_time
+
+    record_restart()
+    if not ready:
+        await event.respond(f"Bot restarted but is not ready after {elapsed_time:.0f} seconds (state: {supervisor.state}).")
+        return
+    await event.respond(f"Bot rebooted in {elapsed_time:.2f} seconds.")
+    logging.info("Bot rebooted.")
 
+async def main_bot_request(method, path, timeout=10, **kwargs):
+    """Calls the main bot's HTTP API without blocking the event loop, which also drains the
+    bot's output. Returns (status code, body text)."""
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async with session.request(method, f"{MAIN_BOT_URL}{path}", **kwargs) as response:
+            return response.status, await response.text()
+
+async def rebuild_knowledge_base(event):
+    logging.info("Rebuilding the knowledge base...")
+    try:
+        status_code, body = await main_bot_request("POST", "/rebuild_vectorstore")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Failed to reach the main bot: {str(e)}")
+        await event.respond("Could not reach the main bot. Is it running?")
+        return
+    if status_code != 202:
+        logging.error(f"Failed to start rebuild. Status code: {status_code}")
+        await event.respond(f"Failed to start the rebuild. Status code: {status_code}")
+        return
+    await event.respond(f"{json.loads(body)['message']}. The bot keeps answering while it runs.")
+
+    # Poll until the rebuild (and any follow-up it coalesced) is done
     while True:
-        line = process.stdout.readline()
-        if not line:
-            break
-        logging.info(line.strip())
-        if "Running on http://0.0.0.0:5001 (CTRL + C to quit)" in line:
+        await asyncio.sleep(5)
+        try:
+            _, body = await main_bot_request("GET", "/rebuild_status")
+            status = json.loads(body)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.error(f"Lost contact with the main bot during rebuild: {str(e)}")
+            await event.respond("Lost contact with the main bot during the rebuild.")
+            return
+        if status["state"] == "idle":
             break
 
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-
-    stats["last_restart"] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
-    await event.respond("Bot rebooted.")
-    logging.info("Bot rebooted.")
+    if status["last_error"]:
+        await event.respond(f"Rebuild failed: {status['last_error']}")
+        return
+    stats["last_rebuild"] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    await event.respond(f"Knowledge base rebuilt in {status['duration']:.2f} seconds.")
+    logging.info("Knowledge base rebuilt.")
+
+async def fetch_metrics():
+    """Reads the main bot's /metrics endpoint and folds the totals into stats."""
+    status_code, body = await main_bot_request("GET", "/metrics")
+    if status_code != 200:
+        raise aiohttp.ClientError(f"/metrics answered {status_code}")
+    values = parse_metrics(body)
+    stats["total_queries"] = int(sum(value for name, value in values.items() if name.startswith("chatbot_queries_total")))
+    stats["articles_pulled"] = int(sum(values.get(f'chatbot_rebuild_records{{change="{change}"}}', 0)
+                                       for change in ("added", "updated", "unchanged")))
+    return values
+
+def average(values, name):
+    count = values.get(f"{name}_count", 0)
+    return values.get(f"{name}_sum", 0) / count if count else 0.0
+
+async def show_stats(event):
+    logging.info("Fetching stats...")
+    state = await supervisor.refresh_state()
+    try:
+        values = await fetch_metrics()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Failed to fetch metrics: {str(e)}")
+        await event.respond(f"Could not reach the main bot (process state: {state}).")
+        return
+
+    uptime = time.time() - stats["start_time"]
+    process = supervisor.status()
+    cached = int(values.get('chatbot_queries_total{outcome="cached"}', 0))
+    rejected = int(values.get('chatbot_queries_total{outcome="rejected"}', 0))
+    coalesced = int(values.get('chatbot_queries_total{outcome="coalesced"}', 0))
+    message = (
+        f"<b>Bot process:</b> {state}"
+        f" (pid {process['pid']}, up {process['uptime'] / 3600:.1f}h, {process['restarts']} automatic restarts)\n"
+        f"<b>Queries:</b> {stats['total_queries']} (cached {cached}, coalesced {coalesced}, rejected {rejected})\n"
+        f"<b>In flight / queued:</b> {int(values.get('chatbot_queries_in_flight', 0))}"
+        f" / {int(values.get('chatbot_query_queue_depth', 0))}\n"
+        f"<b>Average answer time:</b> {average(values, 'chatbot_query_seconds'):.2f}s"
+        f" (first token {average(values, 'chatbot_llm_time_to_first_token_seconds'):.2f}s,"
+        f" retrieval {average(values, 'chatbot_retrieval_seconds'):.2f}s)\n"
+        f"<b>Answer cache hit rate:</b> {values.get('chatbot_answer_cache_hit_ratio', 0):.0%}\n"
+        f"<b>Embedding cache hit rate:</b> {values.get('chatbot_embedding_cache_hit_ratio', 0):.0%}\n"
+        f"<b>Articles indexed:</b> {stats['articles_pulled']}"
+        f" ({int(values.get('chatbot_index_chunks', 0))} chunks)\n"
+        f"<b>Rebuilds:</b> {int(values.get('chatbot_rebuild_seconds_count', 0))}"
+        f" (average {average(values, 'chatbot_rebuild_seconds'):.1f}s)\n"
+        f"<b>Last restart:</b> {stats['last_restart']}\n"
+        f"<b>Last rebuild:</b> {stats['last_rebuild']}\n"
+        f"<b>Admin bot uptime:</b> {uptime / 3600:.1f}h"
+    )
+    await event.respond(message, parse_mode='html')
 
 async def download_db(event):
     logging.info("Downloading the database...")
@@ -211,15 +321,18 @@ async def download_db(event):
         'Accept': 'application/json'
     }
     
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url, headers=headers) as response:
+            status_code = response.status
+            data = await response.json() if status_code == 200 else None
+    if status_code == 200:
         with open('info.json', 'w') as file:
-            json.dump(response.json(), file, indent=4)
+            json.dump(data, file, indent=4)
         
         await event.respond("Database downloaded successfully.")
         await client.send_file(event.chat_id, 'info.json', caption="Here is the downloaded database.")
     else:
-        logging.error(f"Failed to download the database. Status code: {response.status_code}")
+        logging.error(f"Failed to download the database. Status code: {status_code}")
         await event.respond("Failed to download the database.")
 
 async def delete_article_prompt(event):
@@ -242,9 +355,9 @@ async def handle_new_message(event):
             await event.respond("Enter the correct answer:")
         elif state["step"] == "ask_answer":
             state["answer"] = event.text.strip()
-            await add_info_to_db(sender_id, state["question"], state["answer"])
+            message = await add_info_to_db(sender_id, state["question"], state["answer"])
             del add_info_state[sender_id]
-            await event.respond("The question and answer have been added to the supplemental database.")
+            await event.respond(message)
 
 async def add_info_prompt(event):
     sender_id = event.sender_id
@@ -252,22 +365,22 @@ async def add_info_prompt(event):
     await event.respond("Enter the question:")
 
 async def add_info_to_db(sender_id, question, answer):
-    supplemental_info = {
-        "question": question,
-        "answer": answer
-    }
-    file_path = 'supplemental_info.json'
-    
-    if os.path.exists(file_path):
-        with open(file_path, 'r') as file:
-            data = json.load(file)
-    else:
-        data = []
-
-    data.append(supplemental_info)
-
-    with open(file_path, 'w') as file:
-        json.dump(data, file, indent=4)
+    """Sends the entry to the running bot so it is searchable right away, or stores it for the next start."""
+    try:
+        status_code, body = await main_bot_request("POST", "/supplemental", timeout=30,
+                                                   json={"question": question, "answer": answer},
+                                                   headers={"X-Admin-Token": ADMIN_API_TOKEN or ""})
+        if status_code in (200, 202):
+            result = json.loads(body)
+            if result.get("indexed"):
+                return "The question and answer have been added and are live now."
+            return f"The question and answer have been added. {result.get('message', '')}".strip()
+        logging.error(f"Failed to add supplemental info. Status code: {status_code}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.warning(f"Main bot unreachable, storing supplemental info locally: {str(e)}")
+
+    SupplementalStore().put(question, answer)
+    return "The question and answer have been added to the supplemental database. They will be live after the next rebuild."
 
 async def delete_article(event, article_id):
     url = f"https://api.intercom.io/articles/{article_id}"
@@ -276,17 +389,19 @@ async def delete_article(event, article_id):
         "Authorization": f"Bearer {intercom_token}"
     }
 
-    response = requests.delete(url, headers=headers)
-    if response.status_code == 200:
-        data = response.json()
+    async with aiohttp.ClientSession() as session:
+        async with session.delete(url, headers=headers) as response:
+            status_code = response.status
+            data = await response.json() if status_code == 200 else None
+    if status_code == 200:
         if data.get('deleted'):
             await event.respond(f"Article with ID {article_id} deleted successfully.")
         else:
             await event.respond(f"Failed to delete article with ID {article_id}.")
-    elif response.status_code == 404:
+    elif status_code == 404:
         await event.respond(f"Article with ID {article_id} not found.")
     else:
-        logging.error(f"Failed to delete article with ID {article_id}. Status code: {response.status_code}")
-        await event.respond(f"Failed to delete article with ID {article_id}. Status code: {response.status_code}")
+        logging.error(f"Failed to delete article with ID {article_id}. Status code: {status_code}")
+        await event.respond(f"Failed to delete article with ID {article_id}. Status code: {status_code}")
 
 client.run_until_disconnected()
@@ -0,0 +1,66 @@
+# answer_cache.py
+import time
+from collections import OrderedDict
+import numpy as np
+
+class SemanticAnswerCache:
+    """LRU cache of generated answers, looked up by cosine similarity of query embeddings.
+
+    Entries expire after ttl_seconds and are ignored once the index version they were
+    answered against is no longer current.
+    """
+
+    def __init__(self, max_entries, similarity_threshold, ttl_seconds):
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # normalized query -> (unit embedding, response, created_at, index_version)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query):
+        return " ".join(query.lower().split())
+
+    def _expire(self, index_version):
+        now = time.time()
+        for key in [key for key, (_, _, created_at, version) in self.entries.items()
+                    if version != index_version or now - created_at > self.ttl_seconds]:
+            del self.entries[key]
+
+    def lookup(self, query, embedding, index_version):
+        """Returns (response, similarity) for the closest cached query above the threshold, else None."""
+        self._expire(index_version)
+        key = self.normalize(query)
+        if key in self.entries:
+            best_key, best_similarity = key, 1.0
+        else:
+            best_key, best_similarity = None, self.similarity_threshold
+            vector = unit_vector(embedding)
+            for candidate, (candidate_vector, _, _, _) in self.entries.items():
+                similarity = float(np.dot(vector, candidate_vector))
+                if similarity >= best_similarity:
+                    best_key, best_similarity = candidate, similarity
+
+        if best_key is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(best_key)
+        return self.entries[best_key][1], best_similarity
+
+    def store(self, query, embedding, response, index_version):
+        key = self.normalize(query)
+        self.entries[key] = (unit_vector(embedding), response, time.time(), index_version)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+def unit_vector(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
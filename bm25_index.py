@@ -0,0 +1,89 @@
+# bm25_index.py
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from langchain.docstore.document import Document
+
+# Keeps compound terms such as error codes ("err-1042") and versions ("v2.3") together
+TOKEN_PATTERN = re.compile(r"\w+(?:[-_.]\w+)*")
+
+def tokenize(text):
+    """Lowercases text into terms, indexing compound terms both whole and by their parts."""
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        terms.append(token)
+        parts = re.split(r"[-_.]", token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part)
+    return terms
+
+class BM25Index:
+    """In-process inverted index that scores documents with Okapi BM25.
+
+    Documents can be added, replaced and removed one at a time, so the index can follow
+    incremental updates to the vector store. All methods are thread-safe.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)  # term -> {doc id: term frequency}
+        self.doc_terms = {}  # doc id -> Counter of its terms
+        self.doc_lengths = {}  # doc id -> number of terms, kept so scoring doesn't re-sum them
+        self.documents = {}  # doc id -> Document
+        self.total_length = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, doc_id, text, metadata):
+        terms = Counter(tokenize(text))
+        with self.lock:
+            self._remove(doc_id)
+            for term, frequency in terms.items():
+                self.postings[term][doc_id] = frequency
+            self.doc_terms[doc_id] = terms
+            self.doc_lengths[doc_id] = length = sum(terms.values())
+            self.documents[doc_id] = Document(page_content=text, metadata=metadata)
+            self.total_length += length
+
+    def remove(self, doc_id):
+        with self.lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        terms = self.doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            postings = self.postings[term]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[term]
+        self.documents.pop(doc_id, None)
+        self.total_length -= self.doc_lengths.pop(doc_id)
+
+    def search(self, query, k):
+        """Returns up to k (Document, score) pairs, best first."""
+        with self.lock:
+            doc_count = len(self.documents)
+            if not doc_count:
+                return []
+            average_length = self.total_length / doc_count
+            # norm = k1 * (1 - b + b * length / average_length), split into its constant and per-length parts
+            norm_base = self.k1 * (1 - self.b)
+            norm_per_term = self.k1 * self.b / average_length
+            doc_lengths = self.doc_lengths
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, frequency in postings.items():
+                    norm = norm_base + norm_per_term * doc_lengths[doc_id]
+                    scores[doc_id] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            return [(self.documents[doc_id], score) for doc_id, score in best]
@@ -1,34 +1,147 @@
 # data_processor.py
 import aiohttp
+import asyncio
 import json
 import logging
+import os
+import time
 
-async def fetch_all_pages(intercom_token):
-    url = 'https://api.intercom.io/articles'
+INTERCOM_API_URL = os.getenv('INTERCOM_API_URL', 'https://api.intercom.io')
+INTERCOM_PAGE_SIZE = int(os.getenv('INTERCOM_PAGE_SIZE', '250'))
+INTERCOM_FETCH_CONCURRENCY = int(os.getenv('INTERCOM_FETCH_CONCURRENCY', '4'))
+INTERCOM_MAX_RETRIES = int(os.getenv('INTERCOM_MAX_RETRIES', '5'))
+INTERCOM_REQUEST_TIMEOUT = float(os.getenv('INTERCOM_REQUEST_TIMEOUT', '60'))
+# How often the changed-since sync is replaced by a full one so deleted articles get noticed
+INTERCOM_FULL_SYNC_HOURS = float(os.getenv('INTERCOM_FULL_SYNC_HOURS', '24'))
+
+sync_state_file = os.getenv('SYNC_STATE_PATH', 'logs/sync_state.json')
+
+def load_sync_state():
+    if not os.path.exists(sync_state_file):
+        return {}
+    try:
+        with open(sync_state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read sync state {sync_state_file}: {str(e)}")
+        return {}
+
+def save_sync_state(state):
+    os.makedirs(os.path.dirname(sync_state_file), exist_ok=True)
+    with open(sync_state_file, 'w') as f:
+        json.dump(state, f)
+
+def retry_delay(response, backoff):
+    """Works out how long to wait before retrying a throttled or failed request."""
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+    reset_at = response.headers.get('X-RateLimit-Reset')
+    if reset_at:
+        try:
+            return max(float(reset_at) - time.time(), 0)
+        except ValueError:
+            pass
+    return backoff
+
+async def fetch_page(session, headers, page):
+    """Fetches one page of articles, retrying on 429 and 5xx responses, connection errors and
+    timeouts. Returns None on failure."""
+    url = f"{INTERCOM_API_URL}/articles"
+    params = {'page': page, 'per_page': INTERCOM_PAGE_SIZE}
+    backoff = 1
+    for attempt in range(INTERCOM_MAX_RETRIES + 1):
+        try:
+            async with session.get(url, headers=headers, params=params) as response:
+                if response.status == 200:
+                    return await response.json()
+                if response.status != 429 and response.status < 500:
+                    logging.error(f"Failed to fetch data: {response.status}")
+                    return None
+                delay = retry_delay(response, backoff)
+                logging.warning(f"Fetching page {page} returned {response.status}, retrying in {delay:.1f}s")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            delay = backoff
+            reason = str(e) or type(e).__name__
+            logging.warning(f"Fetching page {page} failed: {reason}, retrying in {delay:.1f}s")
+        if attempt < INTERCOM_MAX_RETRIES:
+            await asyncio.sleep(delay)
+            backoff = min(backoff * 2, 60)
+    logging.error(f"Giving up on page {page} after {INTERCOM_MAX_RETRIES} retries")
+    return None
+
+def page_is_older_than(articles, checkpoint):
+    return all((article.get('updated_at') or 0) <= checkpoint for article in articles)
+
+async def iter_article_pages(intercom_token, changed_since=None):
+    """Yields Intercom article pages as lists of article dicts, in page order.
+
+    Pages are prefetched INTERCOM_FETCH_CONCURRENCY at a time. When changed_since (a unix
+    timestamp) is given, paging stops after the first page whose articles were all updated
+    at or before it, relying on Intercom listing articles by updated_at descending.
+    Raises RuntimeError if a page cannot be fetched, since a partial article list would
+    look like mass deletions downstream.
+    """
     headers = {
         'Authorization': f'Bearer {intercom_token}',
         'Accept': 'application/json'
     }
-    all_data = []
 
-    async with aiohttp.ClientSession() as session:
-        while url:
-            async with session.get(url, headers=headers) as response:
-                if response.status != 200:
-                    logging.error(f"Failed to fetch data: {response.status}")
-                    break
-                data = await response.json()
-                articles = data.get('data', [])
-                all_data.extend(articles)
-                url = data.get('pages', {}).get('next', None)
-
-    # Check to ensure all_data is a list of dictionaries
-    if not all(isinstance(item, dict) for item in all_data):
-        logging.error("Fetched data is not a list of dictionaries.")
-        return None
+    timeout = aiohttp.ClientTimeout(total=INTERCOM_REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        semaphore = asyncio.Semaphore(INTERCOM_FETCH_CONCURRENCY)
+
+        async def fetch_limited(page):
+            async with semaphore:
+                return await fetch_page(session, headers, page)
+
+        first_page = await fetch_page(session, headers, 1)
+        if first_page is None:
+            raise RuntimeError("Failed to fetch page 1 of Intercom articles")
+        total_pages = first_page.get('pages', {}).get('total_pages') or 1
+        yield first_page.get('data', [])
+        if changed_since is not None and page_is_older_than(first_page.get('data', []), changed_since):
+            return
 
-    with open('info.json', 'w') as f:
-        json.dump(all_data, f, indent=2)
+        # Fetch one window of pages at a time so memory stays bounded and changed-since
+        # syncs can stop early
+        next_page = 2
+        while next_page <= total_pages:
+            window_end = min(total_pages, next_page + INTERCOM_FETCH_CONCURRENCY - 1)
+            tasks = [asyncio.create_task(fetch_limited(page)) for page in range(next_page, window_end + 1)]
+            try:
+                for page, task in zip(range(next_page, window_end + 1), tasks):
+                    data = await task
+                    if data is None:
+                        raise RuntimeError(f"Failed to fetch page {page} of Intercom articles")
+                    yield data.get('data', [])
+                    if changed_since is not None and page_is_older_than(data.get('data', []), changed_since):
+                        return
+            finally:
+                for task in tasks:
+                    task.cancel()
+            next_page = window_end + 1
+
+def sync_checkpoint(index_stamp):
+    """Returns the changed_since timestamp for the next sync, or None when a full sync is due.
+
+    The checkpoint only counts for the index it was saved against, so a rebuilt or
+    re-stamped index always starts with a full sync.
+    """
+    state = load_sync_state()
+    if state.get('index_stamp') != index_stamp:
+        return None
+    if time.time() - state.get('last_full_sync', 0) > INTERCOM_FULL_SYNC_HOURS * 3600:
+        return None
+    return state.get('updated_at')
 
-    logging.info(f"Total records received: {len(all_data)}")
-    return 'info.json'
+def save_sync_checkpoint(updated_at, full_sync, index_stamp):
+    state = load_sync_state()
+    state['updated_at'] = max(updated_at, state.get('updated_at', 0) if not full_sync else 0)
+    if full_sync:
+        state['last_full_sync'] = time.time()
+    state['index_stamp'] = index_stamp
+    save_sync_state(state)
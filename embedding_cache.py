@@ -0,0 +1,129 @@
+# embedding_cache.py
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+# SQLite refuses statements with more host parameters than this
+MAX_SQL_VARIABLES = 900
+
+class EmbeddingCache:
+    """Persistent cache of embedding vectors keyed by a hash of (model name, normalized text).
+
+    Vectors are stored as float32 blobs in SQLite. Once the stored vectors exceed max_bytes
+    the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_bytes):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.split())
+
+    @classmethod
+    def make_key(cls, model_name, text):
+        return hashlib.sha256(f"{model_name}\0{cls.normalize(text)}".encode('utf-8')).hexdigest()
+
+    def get_many(self, model_name, texts):
+        """Returns a list aligned with texts holding the cached vector or None for each."""
+        keys = [self.make_key(model_name, text) for text in texts]
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), MAX_SQL_VARIABLES):
+                batch = keys[start:start + MAX_SQL_VARIABLES]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                      [(now, key) for key in found])
+                self.conn.commit()
+
+            vectors = []
+            for key in keys:
+                blob = found.get(key)
+                if blob is None:
+                    self.misses += 1
+                    vectors.append(None)
+                else:
+                    self.hits += 1
+                    vectors.append(array('f', blob).tolist())
+        return vectors
+
+    def put_many(self, model_name, texts, vectors):
+        now = time.time()
+        rows = {}
+        for text, vector in zip(texts, vectors):
+            blob = array('f', vector).tobytes()
+            rows[self.make_key(model_name, text)] = (blob, len(blob))
+
+        with self.lock:
+            for start in range(0, len(rows), MAX_SQL_VARIABLES):
+                batch = list(rows)[start:start + MAX_SQL_VARIABLES]
+                placeholders = ','.join('?' * len(batch))
+                replaced = self.conn.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchone()[0]
+                self.total_bytes -= replaced
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)",
+                [(key, blob, size, now) for key, (blob, size) in rows.items()]
+            )
+            self.total_bytes += sum(size for _, size in rows.values())
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        """Drops least recently used entries until the cache is back under max_bytes."""
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_used LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            victims = []
+            for key, size in rows:
+                victims.append((key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+            self.conn.executemany("DELETE FROM embeddings WHERE key = ?", victims)
+            self.evictions += len(victims)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": self.total_bytes,
+        }
+
+    def stats_line(self):
+        return f"{self.hits} hits, {self.misses} misses, {self.total_bytes} bytes cached"
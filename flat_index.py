@@ -0,0 +1,87 @@
+# flat_index.py
+import json
+import logging
+import os
+import numpy as np
+from langchain.docstore.document import Document
+
+class FlatIndex:
+    """Exact cosine-similarity search over a memory-mapped matrix of unit-length float32 rows.
+
+    Row i of the matrix belongs to ids[i], documents[i] and metadatas[i]. For a corpus of a
+    few thousand chunks a single matrix product beats an approximate index and needs no
+    database.
+    """
+
+    def __init__(self, ids, matrix, documents, metadatas):
+        self.ids = ids
+        self.matrix = matrix
+        self.documents = documents
+        self.metadatas = metadatas
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def write(path, ids, embeddings, documents, metadatas):
+        """Saves a snapshot to `path` (.npy) plus a `<path>.meta.json` sidecar.
+
+        Both files are written to temporary names and moved into place, so a process that
+        already has the old snapshot mapped keeps reading it undisturbed.
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        matrix = np.lib.format.open_memmap(f"{path}.tmp", mode='w+', dtype=np.float32, shape=vectors.shape)
+        matrix[:] = vectors / norms
+        matrix.flush()
+        del matrix
+        with open(f"{path}.meta.json.tmp", 'w') as f:
+            json.dump({"ids": ids, "documents": documents, "metadatas": metadatas}, f, separators=(',', ':'))
+        os.replace(f"{path}.tmp", path)
+        os.replace(f"{path}.meta.json.tmp", f"{path}.meta.json")
+
+    @classmethod
+    def load(cls, path):
+        """Opens a snapshot with the matrix memory-mapped read-only."""
+        with open(f"{path}.meta.json", 'r') as f:
+            meta = json.load(f)
+        matrix = np.load(path, mmap_mode='r')
+        if matrix.shape[0] != len(meta["ids"]):
+            raise ValueError(f"Flat index {path} has {matrix.shape[0]} rows but {len(meta['ids'])} ids")
+        return cls(meta["ids"], matrix, meta["documents"], meta["metadatas"])
+
+    @classmethod
+    def from_store(cls, store, path):
+        """Snapshots every chunk in a Chroma collection to path and opens the result."""
+        existing = store.get(include=["embeddings", "documents", "metadatas"])
+        if not existing["ids"]:
+            return cls([], np.zeros((0, 0), dtype=np.float32), [], [])
+        cls.write(path, existing["ids"], existing["embeddings"], existing["documents"], existing["metadatas"])
+        logging.info(f"Wrote flat index with {len(existing['ids'])} rows to {path}")
+        return cls.load(path)
+
+    def search_batch(self, query_embeddings, k):
+        """Returns, for each query, up to k (Document, cosine similarity) pairs, best first."""
+        if not len(self.ids):
+            return [[] for _ in query_embeddings]
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        scores = (queries / norms) @ self.matrix.T
+        k = min(k, scores.shape[1])
+        # argpartition finds the top k of each row in linear time; only those k get sorted
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in zip(scores, top):
+            ranked = candidates[np.argsort(-row[candidates])]
+            results.append([
+                (Document(page_content=self.documents[i], metadata=self.metadatas[i]), float(row[i]))
+                for i in ranked
+            ])
+        return results
+
+    def search(self, query_embedding, k):
+        return self.search_batch([query_embedding], k)[0]
@@ -0,0 +1,197 @@
+# html_text.py
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from itertools import groupby
+
+HTML_TEXT_CACHE_SIZE = int(os.getenv('HTML_TEXT_CACHE_SIZE', '4096'))
+HTML_STRIP_WORKERS = int(os.getenv('HTML_STRIP_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Fewer uncached bodies than this are parsed on a thread, since handing them to other processes costs more
+STRIP_POOL_MIN_BODIES = 64
+
+# Tags whose contents should end up on their own line
+BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "dd", "div", "dl", "dt", "figcaption", "figure", "footer",
+    "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main", "nav", "ol", "p",
+    "section", "table", "tbody", "tfoot", "thead", "tr", "ul",
+}
+# Table cells, joined with CELL_SEPARATOR into one line per row
+CELL_TAGS = {"td", "th"}
+CELL_SEPARATOR = " | "
+# Tags whose contents are never user-visible text
+SKIP_TAGS = {"script", "style", "head", "title", "noscript", "template"}
+WHITESPACE = re.compile(r"\s+")
+
+text_cache = OrderedDict()  # sha1 of the HTML -> extracted text
+strip_executor = None
+
+class Verbatim(str):
+    """Text whose whitespace is kept as written, such as inline code."""
+
+class BlockTextParser(HTMLParser):
+    """Streams HTML into text without building a tree.
+
+    Every block element starts a new line, list items are prefixed with "- ", and the cells
+    of a table row share a line. Runs of whitespace inside a line collapse to one space,
+    except in code: <pre> blocks are kept verbatim on lines of their own.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines = []
+        self.current = []
+        self.skip_depth = 0
+        self.pre_depth = 0
+        self.code_depth = 0
+        self.cell_depth = 0
+        self.row_cells = 0
+
+    def break_line(self):
+        parts = []
+        for verbatim, fragments in groupby(self.current, lambda fragment: isinstance(fragment, Verbatim)):
+            text = "".join(fragments)
+            parts.append(text if verbatim else WHITESPACE.sub(" ", text))
+        line = "".join(parts).strip()
+        if line and line != "-":
+            self.lines.append(line)
+        self.current = []
+
+    def break_pre(self):
+        text = "".join(self.current).strip("\n").rstrip()
+        if text.strip():
+            self.lines.append(text)
+        self.current = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+        elif self.pre_depth:
+            if tag == "pre":
+                self.pre_depth += 1
+            elif tag == "br":
+                self.current.append("\n")
+        elif tag == "pre":
+            self.break_line()
+            self.pre_depth = 1
+        elif tag == "code":
+            self.code_depth += 1
+        elif tag in CELL_TAGS:
+            if self.row_cells:
+                self.current.append(CELL_SEPARATOR)
+            self.row_cells += 1
+            self.cell_depth += 1
+        elif tag == "br" or tag in BLOCK_TAGS:
+            if self.cell_depth:
+                # Blocks inside a cell would split its row, so they only separate words
+                self.current.append(" ")
+                return
+            self.break_line()
+            if tag == "tr":
+                self.row_cells = 0
+            elif tag == "li":
+                self.current.append("- ")
+
+    def handle_startendtag(self, tag, attrs):
+        if tag == "br":
+            self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif self.pre_depth:
+            if tag == "pre":
+                self.pre_depth -= 1
+                if not self.pre_depth:
+                    self.break_pre()
+        elif tag == "code":
+            self.code_depth = max(0, self.code_depth - 1)
+        elif tag in CELL_TAGS:
+            self.cell_depth = max(0, self.cell_depth - 1)
+        elif tag in BLOCK_TAGS:
+            if self.cell_depth:
+                self.current.append(" ")
+            else:
+                self.break_line()
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        self.current.append(Verbatim(data) if self.code_depth and not self.pre_depth else data)
+
+    def text(self):
+        self.close()
+        if self.pre_depth:
+            self.break_pre()
+        self.break_line()
+        return "\n".join(self.lines)
+
+def extract_text(content):
+    """Converts HTML to block-aware plain text, bypassing the cache."""
+    parser = BlockTextParser()
+    parser.feed(content)
+    return parser.text()
+
+def extract_text_many(contents):
+    return [extract_text(content) for content in contents]
+
+def get_strip_executor():
+    """Returns the process pool for large strip_html_batch calls, or None to strip on a thread.
+
+    The pool is started on first use and kept for the life of the process, so only the first
+    large rebuild pays for starting its workers.
+    """
+    global strip_executor
+    if strip_executor is None and HTML_STRIP_WORKERS > 1:
+        strip_executor = ProcessPoolExecutor(max_workers=HTML_STRIP_WORKERS,
+                                             mp_context=multiprocessing.get_context('spawn'))
+    return strip_executor
+
+def content_key(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def cache_put(key, text):
+    text_cache[key] = text
+    text_cache.move_to_end(key)
+    while len(text_cache) > HTML_TEXT_CACHE_SIZE:
+        text_cache.popitem(last=False)
+
+def strip_html(content):
+    """Strips HTML tags from content, keeping one line per block element."""
+    key = content_key(content)
+    text = text_cache.get(key)
+    if text is None:
+        text = extract_text(content)
+        cache_put(key, text)
+    else:
+        text_cache.move_to_end(key)
+    return text
+
+async def strip_html_batch(contents):
+    """Strips a list of HTML bodies off the event loop.
+
+    Bodies already in the cache (by content hash) are never re-parsed. At least
+    STRIP_POOL_MIN_BODIES cache misses are split over the HTML_STRIP_WORKERS process pool;
+    fewer are parsed on a thread. Output order matches contents.
+    """
+    keys = [content_key(content) for content in contents]
+    texts = [text_cache.get(key) for key in keys]
+    missing = [i for i, text in enumerate(texts) if text is None]
+    if missing:
+        loop = asyncio.get_running_loop()
+        executor = get_strip_executor() if len(missing) >= STRIP_POOL_MIN_BODIES else None
+        workers = HTML_STRIP_WORKERS if executor is not None else 1
+        slice_size = -(-len(missing) // workers)
+        slices = [missing[start:start + slice_size] for start in range(0, len(missing), slice_size)]
+        results = await asyncio.gather(*(
+            loop.run_in_executor(executor, extract_text_many, [contents[i] for i in indexes]) for indexes in slices
+        ))
+        for indexes, extracted in zip(slices, results):
+            for i, text in zip(indexes, extracted):
+                texts[i] = text
+                cache_put(keys[i], text)
+    return texts
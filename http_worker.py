@@ -0,0 +1,112 @@
+# http_worker.py
+"""Entry point for the HTTP worker processes started when HTTP_WORKERS > 1.
+
+main.py runs `hypercorn --workers N http_worker:app` on the public port and serves its own
+copy of the app on PRIMARY_PORT. Each worker answers /intercom from the flat index snapshot
+the main process keeps at FLAT_INDEX_PATH. The vectors are memory-mapped read-only, so every
+worker shares one copy of them through the page cache. A worker reloads the snapshot when
+it changes and sends generations to the shared Ollama server. Rebuild, supplemental and
+/metrics requests are forwarded to the main process. Every query also takes its slot from the
+main process's scheduler, so QUERY_CONCURRENCY and QUERY_QUEUE_SIZE hold across all workers.
+Each worker's counters and histograms are pushed to the main process, which adds them into its
+/metrics. Telegram is only ever served by the main process.
+"""
+import asyncio
+import logging
+import os
+import time
+import aiohttp
+from dotenv import load_dotenv
+
+# Load environment variables before importing the bot's modules, which read their settings at import time
+load_dotenv()
+
+import metrics
+import telegram_bot
+import vector_store
+import web_server
+from flat_index import FlatIndex
+from query_scheduler import RemoteQueryScheduler
+
+PROMPT_TEMPLATE = os.getenv('PROMPT_TEMPLATE')
+# How often workers check whether the main process has published a new snapshot
+SNAPSHOT_POLL_SECONDS = float(os.getenv('SNAPSHOT_POLL_SECONDS', '1'))
+# How often to complain while there is no snapshot to serve
+MISSING_SNAPSHOT_WARNING_SECONDS = 60
+# How often workers send their counters and histograms to the main process
+METRICS_PUSH_SECONDS = float(os.getenv('METRICS_PUSH_SECONDS', '5'))
+
+logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - worker {os.getpid()} - %(message)s')
+
+app = web_server.app
+web_server.primary_url = f"http://127.0.0.1:{web_server.PRIMARY_PORT}"
+telegram_bot.query_scheduler = RemoteQueryScheduler(web_server.primary_url, web_server.SLOT_LEASE_SECONDS)
+watch_task = None
+push_task = None
+
+class WorkerEmbeddings(vector_store.CustomGPT4AllEmbeddings):
+    """Embeds queries without the SQLite embedding cache, which belongs to the main process."""
+
+    def embed_documents(self, texts):
+        return self.embed_uncached(texts)
+
+def snapshot_mtime():
+    try:
+        return os.stat(f"{vector_store.FLAT_INDEX_PATH}.meta.json").st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def load_snapshot():
+    index = FlatIndex.load(vector_store.FLAT_INDEX_PATH)
+    return vector_store.snapshot_qa_chain(index, PROMPT_TEMPLATE), len(index)
+
+async def watch_snapshot():
+    """Swaps in a QA chain over each new snapshot. Queries get a warming-up reply until the first one."""
+    loop = asyncio.get_running_loop()
+    loaded = None
+    waiting_since = last_warning = time.time()
+    while True:
+        mtime = snapshot_mtime()
+        if mtime is None and loaded is None and time.time() - last_warning >= MISSING_SNAPSHOT_WARNING_SECONDS:
+            logging.warning(f"Still no flat index snapshot at {vector_store.FLAT_INDEX_PATH} after "
+                            f"{time.time() - waiting_since:.0f}s, answering queries with the warming-up reply")
+            last_warning = time.time()
+        if mtime is not None and mtime != loaded:
+            try:
+                qa_chain, rows = await loop.run_in_executor(None, load_snapshot)
+            except (OSError, ValueError) as e:
+                # Most likely caught between the main process replacing the matrix and its sidecar
+                logging.warning(f"Could not load flat index snapshot, retrying: {str(e)}")
+            else:
+                vector_store.bump_index_version()  # Drops answers cached against the old snapshot
+                telegram_bot.set_qa_chain(qa_chain)
+                loaded = mtime
+                logging.info(f"Serving flat index snapshot with {rows} chunks")
+        await asyncio.sleep(SNAPSHOT_POLL_SECONDS)
+
+async def push_metrics():
+    """Sends this worker's running totals to the main process, replacing the ones it sent last time."""
+    source = str(os.getpid())
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+        while True:
+            await asyncio.sleep(METRICS_PUSH_SECONDS)
+            try:
+                async with session.post(f"{web_server.primary_url}/internal/metrics",
+                                        json={"source": source, "samples": metrics.snapshot()}) as response:
+                    await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning(f"Could not push metrics to the main process: {str(e)}")
+
+@app.before_serving
+async def start_worker():
+    global watch_task, push_task
+    vector_store.set_embedder(WorkerEmbeddings(model=vector_store.EMBEDDING_MODEL))
+    watch_task = asyncio.create_task(watch_snapshot())
+    push_task = asyncio.create_task(push_metrics())
+
+@app.after_serving
+async def stop_worker():
+    for task in (watch_task, push_task):
+        if task is not None:
+            task.cancel()
+    await telegram_bot.query_scheduler.close()
@@ -0,0 +1,164 @@
+# ingest.py
+import asyncio
+import logging
+import os
+from data_processor import iter_article_pages, sync_checkpoint, save_sync_checkpoint
+from html_text import strip_html_batch
+from supplemental_store import ID_PREFIX as SUPPLEMENTAL_ID_PREFIX
+from vector_store import (
+    EMBED_BATCH_SIZE, EMBED_WORKERS, build_qa_chain, classify_record, current_index_stamp, delete_documents,
+    embed_texts, ensure_vectorstore, get_embedding_cache, get_embedding_executor, get_indexed_state,
+    load_supplemental_records, log_rebuild_counts, prepare_record, release_embedding_executor, upsert_documents, export_embeddings, write_index_stamp, bump_index_version
+)
+
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '8'))
+
+DONE = None  # Queue sentinel telling the next stage its producer has finished
+
+async def stream_rebuild_vectorstore(intercom_token, prompt_template, embedding_export_path=None):
+    """Syncs Intercom into the collection through fetch -> strip -> embed -> upsert stages.
+
+    The stages run concurrently and are joined by queues of at most INGEST_QUEUE_SIZE items,
+    so embedding starts while later pages are still downloading and memory stays flat no
+    matter how large the corpus is. Only articles changed since the last sync checkpoint
+    are fetched unless a full sync is due; deletions are only applied on full syncs. If
+    embedding_export_path is set, all vectors are exported there afterwards.
+    Returns a QA chain over the collection.
+    """
+    loop = asyncio.get_running_loop()
+    store = ensure_vectorstore()
+    indexed_state = await loop.run_in_executor(None, get_indexed_state, store)
+    changed_since = sync_checkpoint(current_index_stamp())
+    has_articles = any(not article_id.startswith(SUPPLEMENTAL_ID_PREFIX) for article_id in indexed_state)
+    if changed_since is not None and not has_articles:
+        # The collection was just created or wiped, so a changed-since sync would leave it partial
+        logging.info("No Intercom articles are indexed, doing a full sync.")
+        changed_since = None
+
+    embed_workers = max(1, EMBED_WORKERS)
+    record_queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    batch_queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    upsert_queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+
+    counts = {"received": 0, "added": 0, "updated": 0, "unchanged": 0, "invalid": 0, "removed": 0, "chunks": 0}
+    seen_ids = set()
+    # Chunk ids that are no longer needed; deleted only after the replacements are upserted
+    stale_ids = []
+    latest_updated_at = 0
+
+    async def fetch_stage():
+        nonlocal latest_updated_at
+        async for articles in iter_article_pages(intercom_token, changed_since):
+            counts["received"] += len(articles)
+            latest_updated_at = max([latest_updated_at] + [article.get('updated_at') or 0 for article in articles])
+            await record_queue.put(articles)
+        logging.info(f"Total records received from remote: {counts['received']}")
+        await record_queue.put(load_supplemental_records())
+        await record_queue.put(DONE)
+
+    async def prepare_stage():
+        pending = []
+        while (records := await record_queue.get()) is not DONE:
+            changed = []
+            for record in records:
+                seen_ids.add(str(record.get("id")))
+                status = classify_record(record, indexed_state)
+                if status == "unchanged":
+                    counts["unchanged"] += 1
+                else:
+                    changed.append((record, status))
+            if not changed:
+                continue
+
+            texts = await strip_html_batch([record.get("body") or "" for record, _ in changed])
+            prepared = await loop.run_in_executor(None, lambda: [
+                prepare_record(record, indexed_state, text) for (record, _), text in zip(changed, texts)
+            ])
+            for (record, status), (documents, record_stale_ids) in zip(changed, prepared):
+                stale_ids.extend(record_stale_ids)
+                if documents:
+                    counts[status] += 1
+                    pending.extend(documents)
+                else:
+                    counts["invalid"] += 1
+                    if status == "updated":
+                        counts["removed"] += 1
+                    logging.warning(f"Invalid document: {record}")
+            while len(pending) >= EMBED_BATCH_SIZE:
+                await batch_queue.put(pending[:EMBED_BATCH_SIZE])
+                pending = pending[EMBED_BATCH_SIZE:]
+        if pending:
+            await batch_queue.put(pending)
+        for _ in range(embed_workers):
+            await batch_queue.put(DONE)
+
+    async def embed_stage(in_process):
+        # One stage feeds this process's own model and the rest feed the pool, which is only
+        # started once a rebuild is big enough to reach them
+        while (documents := await batch_queue.get()) is not DONE:
+            executor = None if in_process else get_embedding_executor()
+            embeddings = await embed_texts([doc.page_content for doc in documents], executor)
+            await upsert_queue.put((documents, embeddings))
+        await upsert_queue.put(DONE)
+
+    async def upsert_stage():
+        finished = 0
+        while finished < embed_workers:
+            item = await upsert_queue.get()
+            if item is DONE:
+                finished += 1
+                continue
+            documents, embeddings = item
+            await loop.run_in_executor(None, upsert_documents, store, documents, embeddings)
+            counts["chunks"] += len(documents)
+
+    try:
+        tasks = [
+            asyncio.create_task(fetch_stage()),
+            asyncio.create_task(prepare_stage()),
+            *(asyncio.create_task(embed_stage(in_process=index == 0)) for index in range(embed_workers)),
+            asyncio.create_task(upsert_stage()),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # A failed stage would leave its neighbours blocked on a queue forever
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    except Exception as e:
+        logging.error(f"Error rebuilding vector store: {str(e)}", exc_info=True)
+        raise
+    finally:
+        release_embedding_executor()
+
+    if changed_since is None:
+        deleted = [article_id for article_id in indexed_state if article_id not in seen_ids]
+        stale_ids.extend(doc_id for article_id in deleted for doc_id in indexed_state[article_id]["chunk_ids"])
+        counts["removed"] += len(deleted)
+    if stale_ids:
+        await loop.run_in_executor(None, delete_documents, store, stale_ids)
+    if counts["chunks"] or stale_ids:
+        bump_index_version()
+
+    save_sync_checkpoint(latest_updated_at, full_sync=changed_since is None, index_stamp=current_index_stamp())
+    write_index_stamp()
+    if embedding_export_path:
+        await loop.run_in_executor(None, export_embeddings, store, embedding_export_path)
+
+    logging.info(f"Total valid documents: {counts['added'] + counts['updated'] + counts['unchanged']}")
+    logging.info(f"Total invalid documents: {counts['invalid']}")
+    logging.info(f"Total chunks embedded: {counts['chunks']}")
+    logging.info(f"Embedding cache: {get_embedding_cache().stats_line()}")
+    log_rebuild_counts(counts["added"], counts["updated"], counts["removed"], counts["unchanged"])
+
+    if not await loop.run_in_executor(None, store._collection.count):
+        logging.error("No valid documents with non-empty body found.")
+        return None
+    logging.info("Vector store successfully rebuilt.")
+    # Building the chain loads the keyword index and, with the flat backend, the snapshot,
+    # both of which read the whole collection
+    qa_chain = await loop.run_in_executor(None, build_qa_chain, store, prompt_template)
+    logging.info("QA chain initialized successfully.")
+    return qa_chain
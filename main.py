@@ -6,25 +6,40 @@ import os
 import subprocess
 import signal
 import sys
+import aiohttp
 import psutil
 from dotenv import load_dotenv
 from telethon import TelegramClient
-from data_processor import fetch_all_pages
-from vector_store import rebuild_vectorstore
-from telegram_bot import start_telegram_client
-from web_server import run_server
 
-# Load environment variables
+# Load environment variables before importing the bot's modules, which read their settings at import time
 load_dotenv()
+
+from ingest import stream_rebuild_vectorstore
+from vector_store import (
+    FLAT_INDEX_PATH, HTTP_WORKERS, OLLAMA_BASE_URL, OLLAMA_KEEP_ALIVE, OLLAMA_KEEP_ALIVE_SECONDS, OLLAMA_MODEL,
+    OLLAMA_OPTIONS, RETRIEVER_BACKEND, load_vectorstore, shutdown_embedding_executor
+)
+from rebuild_manager import RebuildManager
+from startup import StartupTracker
+import telegram_bot
+from telegram_bot import start_telegram_client, set_qa_chain
+from web_server import HTTP_PORT, PRIMARY_PORT, run_server
+
 api_id = os.getenv('API_ID')
 api_hash = os.getenv('API_HASH')
 bot_token = os.getenv('BOT_TOKEN')
 chat_id = int(os.getenv('CHAT_ID'))
 intercom_token = os.getenv('INTERCOM_TOKEN')
 
-json_file_path = 'info.json'
 prompt_template = os.getenv('PROMPT_TEMPLATE')
-embedding_log_file = 'logs/embeddings_log.txt'
+# Optional binary dump of every vector (float32 .npy + .ids.json sidecar) for offline analysis
+embedding_export_path = os.getenv('EMBEDDING_EXPORT_PATH')
+# How long to wait for `ollama serve` to start answering before giving up on that phase
+OLLAMA_STARTUP_TIMEOUT = float(os.getenv('OLLAMA_STARTUP_TIMEOUT', '60'))
+# Longest wait between attempts at the first sync when there is no persisted index to serve from
+FIRST_SYNC_RETRY_MAX_SECONDS = float(os.getenv('FIRST_SYNC_RETRY_MAX_SECONDS', '300'))
+# Loading the model from disk can take minutes on a cold CPU-only box
+OLLAMA_WARMUP_TIMEOUT = float(os.getenv('OLLAMA_WARMUP_TIMEOUT', '300'))
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s', handlers=[
     logging.FileHandler("logs/app.log"),
@@ -37,13 +52,21 @@ client = None
 ollama_process = None
 ngrok_process = None
 tg_post_process = None
+http_workers_process = None
+keep_warm_task = None
+rebuild_manager = None
+startup_tracker = None
 
 def handle_signal(signal, frame):
     asyncio.run(shutdown())
 
 async def shutdown():
-    global client, ollama_process, ngrok_process, tg_post_process
+    global client, ollama_process, ngrok_process, tg_post_process, http_workers_process
     logging.info("Shutting down...")
+    if keep_warm_task:
+        keep_warm_task.cancel()
+    shutdown_embedding_executor()
+
     if client:
         await client.disconnect()
         logging.info("Client disconnected.")
@@ -64,6 +87,11 @@ async def shutdown():
         await tg_post_process.wait()
         logging.info("tg_post process terminated.")
 
+    if http_workers_process:
+        http_workers_process.terminate()
+        await http_workers_process.wait()
+        logging.info("HTTP workers terminated.")
+
     # Kill processes bound to the port
     port = 5001
     for proc in psutil.process_iter():
@@ -91,23 +119,146 @@ async def start_subprocess(command):
     )
     return process
 
-async def main():
-    global client, ollama_process, ngrok_process, tg_post_process
+async def sync_vectorstore():
+    return await stream_rebuild_vectorstore(intercom_token, prompt_template, embedding_export_path)
+
+async def wait_for_ollama():
+    """Polls the Ollama API until it answers, so the startup log shows when the LLM is reachable."""
+    deadline = time.time() + OLLAMA_STARTUP_TIMEOUT
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2)) as session:
+        while True:
+            try:
+                async with session.get(f"{OLLAMA_BASE_URL}/api/tags") as response:
+                    if response.status == 200:
+                        return
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            if time.time() > deadline:
+                raise RuntimeError(f"Ollama did not respond within {OLLAMA_STARTUP_TIMEOUT:.0f} seconds")
+            await asyncio.sleep(0.5)
+
+async def warm_up_ollama(prompt, num_predict=1):
+    """Asks Ollama to load the model, or keep it loaded, for another OLLAMA_KEEP_ALIVE.
+
+    Sends the same keep_alive and options as the QA chain's LLM, since a request with different
+    load options would make Ollama reload the model. An empty prompt only loads the model.
+    """
+    payload = {
+        "model": OLLAMA_MODEL,
+        "prompt": prompt,
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": dict(OLLAMA_OPTIONS, num_predict=num_predict),
+    }
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=OLLAMA_WARMUP_TIMEOUT)) as session:
+        async with session.post(f"{OLLAMA_BASE_URL}/api/generate", json=payload) as response:
+            if response.status != 200:
+                raise RuntimeError(f"Ollama warm-up failed with status {response.status}: {await response.text()}")
+            await response.read()
+
+async def keep_ollama_warm():
+    """Pings Ollama often enough that the model is never unloaded between quiet-hour queries."""
+    if OLLAMA_KEEP_ALIVE_SECONDS <= 0:
+        logging.info(f"OLLAMA_KEEP_ALIVE is {OLLAMA_KEEP_ALIVE}, not sending keep-warm pings")
+        return
+    # Half the keep-alive, so one lost ping still leaves time for the next before the model unloads
+    interval = OLLAMA_KEEP_ALIVE_SECONDS / 2
+    logging.info(f"Sending Ollama keep-warm pings every {interval:.1f} seconds")
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await warm_up_ollama("", num_predict=0)
+        except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+            logging.warning(f"Ollama keep-warm ping failed: {str(e)}")
+        except Exception as e:
+            # Keep pinging; a dead task would let the model unload without anyone noticing
+            logging.error(f"Unexpected error in Ollama keep-warm ping: {str(e)}", exc_info=True)
+
+async def start_ollama():
+    global ollama_process
     try:
-        logging.info("Starting ollama serve and ngrok tunnel")
-        # Start ollama serve and ngrok tunnel
-        ollama_process = await start_subprocess('ollama serve')
+        async with startup_tracker.phase("ollama"):
+            ollama_process = await start_subprocess('ollama serve')
+            await wait_for_ollama()
+            # Load the model now so the first user doesn't wait for it; /readyz holds off until this is done
+            await warm_up_ollama("Hello")
+    except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+        # Ollama may already be running elsewhere or come up later; queries will report errors meanwhile
+        logging.error(f"Ollama startup failed: {str(e)}")
+
+async def start_ngrok():
+    global ngrok_process
+    async with startup_tracker.phase("ngrok"):
         ngrok_process = await start_subprocess('ngrok http --domain=boom.ngrok.app 127.0.0.1:5001')
 
-        logging.info("Fetching data and rebuilding vector store")
-        await fetch_all_pages(intercom_token)  # Ensure data is fetched correctly
-        qa_chain = await rebuild_vectorstore(json_file_path, prompt_template, embedding_log_file)
-        
-        logging.info("Starting Telegram client")
-        client = await start_telegram_client(api_id, api_hash, bot_token, qa_chain)
-        
+async def start_http_workers():
+    """Starts the hypercorn workers that serve the public port from the flat index snapshot."""
+    global http_workers_process
+    async with startup_tracker.phase("http_workers"):
+        # The settings this process writes the snapshot and listens with are passed down explicitly,
+        # so the workers can't read a different snapshot path or primary port from their own environment
+        env = dict(os.environ, HTTP_WORKERS=str(HTTP_WORKERS), RETRIEVER_BACKEND=RETRIEVER_BACKEND,
+                   FLAT_INDEX_PATH=os.path.abspath(FLAT_INDEX_PATH), PRIMARY_PORT=str(PRIMARY_PORT))
+        # Not piped: the workers log to this process's stdout and stderr
+        http_workers_process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'hypercorn', '--workers', str(HTTP_WORKERS),
+            '--bind', f"0.0.0.0:{HTTP_PORT}", 'http_worker:app', env=env
+        )
+
+async def start_telegram():
+    global client
+    async with startup_tracker.phase("telegram"):
+        client = await start_telegram_client(api_id, api_hash, bot_token)
+
+async def load_index():
+    """Serves from the persisted index if there is one, otherwise waits for the first sync with Intercom."""
+    async with startup_tracker.phase("index"):
+        qa_chain = await asyncio.get_running_loop().run_in_executor(None, load_vectorstore, prompt_template)
+        if qa_chain:
+            # Serve from the persisted index right away and catch up with Intercom in the background
+            logging.info("Vector store loaded from disk, syncing with Intercom in the background")
+            set_qa_chain(qa_chain)
+            rebuild_manager.request()
+        else:
+            # Nothing to serve until a sync succeeds, so keep trying rather than staying unready forever
+            backoff = 5
+            while True:
+                logging.info("Fetching data and rebuilding vector store")
+                rebuild_manager.request()
+                await rebuild_manager.task
+                if telegram_bot.qa_chain is not None:
+                    break
+                reason = rebuild_manager.status["last_error"] or "no documents were indexed"
+                logging.error(f"First sync with Intercom failed ({reason}), retrying in {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, FIRST_SYNC_RETRY_MAX_SECONDS)
+
+async def main():
+    global rebuild_manager, startup_tracker, keep_warm_task
+    try:
+        startup_tracker = StartupTracker()
+        rebuild_manager = RebuildManager(sync_vectorstore, set_qa_chain)
+
+        # The web server answers health checks (and tells queries to wait) while everything else starts
         logging.info("Running web server")
-        await run_server()
+        phases = [start_ollama(), start_ngrok(), start_telegram(), load_index()]
+        if HTTP_WORKERS > 1:
+            # The workers take the public port; this process serves them rebuilds, supplemental updates,
+            # scheduler slots and metrics
+            logging.info(f"Starting {HTTP_WORKERS} HTTP workers")
+            server_task = asyncio.create_task(run_server(rebuild_manager, startup_tracker,
+                                                        f"127.0.0.1:{PRIMARY_PORT}", serve_workers=True))
+            phases.append(start_http_workers())
+        else:
+            server_task = asyncio.create_task(run_server(rebuild_manager, startup_tracker))
+
+        logging.info("Starting ollama serve and ngrok tunnel")
+        logging.info("Starting Telegram client")
+        await asyncio.gather(*phases)
+        logging.info(f"Startup complete: {startup_tracker.breakdown()}")
+        keep_warm_task = asyncio.create_task(keep_ollama_warm())
+
+        await server_task
     except Exception as e:
         logging.error(f"Error in main: {str(e)}", exc_info=True)
     finally:
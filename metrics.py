@@ -0,0 +1,172 @@
+# metrics.py
+import math
+
+# Upper bounds in seconds, spanning cached answers up to slow full generations
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+PROMPT_TOKEN_BUCKETS = (128, 256, 512, 768, 1024, 1536, 2048, 3072, 4096)
+REBUILD_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 3600)
+
+registry = []
+# Counter and histogram samples pushed by HTTP worker processes: source -> {metric name: [[suffix, labels, value]]}
+remote_samples = {}
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        registry.append(self)
+
+    def samples(self):
+        """Yields (name suffix, labels, value) tuples."""
+        raise NotImplementedError
+
+    def merged_samples(self):
+        """This process's samples, with those pushed by other processes added in for counters and histograms."""
+        if self.type not in ("counter", "histogram") or not remote_samples:
+            return list(self.samples())
+        totals = {}
+        pushed = (sample for samples in remote_samples.values() for sample in samples.get(self.name, []))
+        for suffix, labels, value in [*self.samples(), *pushed]:
+            key = (suffix, tuple(labels.items()))
+            totals[key] = totals.get(key, 0) + value
+        return [(suffix, dict(labels), value) for (suffix, labels), value in totals.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.merged_samples():
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        if not self.values:
+            yield "", {}, 0
+        for key, value in self.values.items():
+            yield "", dict(key), value
+
+class Gauge(Metric):
+    """A value that is either set directly or read from a function at scrape time."""
+
+    type = "gauge"
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self.values = {}
+        self.function = None
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            yield "", {}, self.function()
+            return
+        if not self.values:
+            yield "", {}, 0
+        for key, value in self.values.items():
+            yield "", dict(key), value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield "_bucket", {"le": format_value(bound)}, cumulative
+        yield "_sum", {}, self.sum
+        yield "_count", {}, self.count
+
+def render():
+    """Returns every registered metric in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+def snapshot():
+    """Returns this process's counter and histogram samples in the form merge_remote takes."""
+    return {metric.name: [[suffix, labels, value] for suffix, labels, value in metric.samples()]
+            for metric in registry if metric.type in ("counter", "histogram")}
+
+def merge_remote(source, samples):
+    """Adds another process's snapshot() into what render() reports, replacing its previous one.
+
+    Gauges are not merged: the ones that matter across processes, such as the queue depth,
+    are kept by the process whose scheduler every worker shares.
+    """
+    remote_samples[source] = samples
+
+def parse(text):
+    """Reads Prometheus text back into {name{labels}: value}, for consumers like the admin bot."""
+    values = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, _, value = line.rpartition(' ')
+        try:
+            values[name] = float(value)
+        except ValueError:
+            continue
+    return values
+
+QUERIES = Counter("chatbot_queries_total", "Queries answered, by outcome.")
+QUERY_EMBEDDING_SECONDS = Histogram("chatbot_query_embedding_seconds", "Time to embed the incoming question.")
+QUEUE_WAIT_SECONDS = Histogram("chatbot_query_queue_wait_seconds", "Time a query waited for a scheduler slot.")
+RETRIEVAL_SECONDS = Histogram("chatbot_retrieval_seconds", "Time spent in the retriever.")
+TIME_TO_FIRST_TOKEN_SECONDS = Histogram("chatbot_llm_time_to_first_token_seconds",
+                                        "Time from the LLM call to its first token (prompt prefill).")
+GENERATION_SECONDS = Histogram("chatbot_llm_generation_seconds", "Time from the first token to the end of the answer.")
+PROMPT_TOKENS = Histogram("chatbot_prompt_tokens", "Approximate tokens in each prompt sent to the LLM.",
+                          PROMPT_TOKEN_BUCKETS)
+QUERY_SECONDS = Histogram("chatbot_query_seconds", "End-to-end time to answer a query.")
+QUEUE_DEPTH = Gauge("chatbot_query_queue_depth", "Queries waiting for a scheduler slot.")
+IN_FLIGHT = Gauge("chatbot_queries_in_flight", "Queries currently running against the LLM.")
+ANSWER_CACHE_LOOKUPS = Counter("chatbot_answer_cache_lookups_total", "Answer cache lookups, by result.")
+ANSWER_CACHE_HIT_RATIO = Gauge("chatbot_answer_cache_hit_ratio", "Share of answer cache lookups that hit.")
+EMBEDDING_CACHE_HIT_RATIO = Gauge("chatbot_embedding_cache_hit_ratio", "Share of embedding cache lookups that hit.")
+REBUILDS = Counter("chatbot_rebuilds_total", "Vector store rebuilds, by result.")
+REBUILD_SECONDS = Histogram("chatbot_rebuild_seconds", "Vector store rebuild duration.", REBUILD_BUCKETS)
+REBUILD_RECORDS = Gauge("chatbot_rebuild_records", "Records in the last rebuild, by change.")
+INDEX_CHUNKS = Gauge("chatbot_index_chunks", "Chunks currently in the vector store.")
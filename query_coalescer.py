@@ -0,0 +1,93 @@
+# query_coalescer.py
+import asyncio
+from contextlib import contextmanager
+
+class Flight:
+    """One generation in progress: the tokens produced so far, who to forward new ones to and its result."""
+
+    def __init__(self):
+        self.tokens = []
+        self.listeners = []
+        self.followers = 0
+        self.result = asyncio.get_running_loop().create_future()
+
+    def publish(self, token):
+        self.tokens.append(token)
+        for listener in list(self.listeners):
+            listener(token)
+
+    def subscribe(self, on_token):
+        for token in self.tokens:
+            on_token(token)
+        self.listeners.append(on_token)
+
+    def unsubscribe(self, on_token):
+        if on_token in self.listeners:
+            self.listeners.remove(on_token)
+
+class QueryCoalescer:
+    """Shares one generation between identical queries that are in flight at the same time.
+
+    Queries are identical when their normalized text matches and they were asked against the
+    same index version. The first one leads and generates; the others follow it, getting the
+    tokens streamed so far, then each new one, then the leader's result. A leader that is
+    cancelled abandons its flight instead of failing it, so its followers can answer the query
+    themselves. Everything runs on the event loop, so no locking is needed.
+    """
+
+    def __init__(self):
+        self.flights = {}  # (normalized query, index version) -> Flight
+
+    @staticmethod
+    def key(query, index_version):
+        return " ".join(query.lower().split()), index_version
+
+    def get(self, query, index_version):
+        """Returns the flight already answering this query, or None."""
+        return self.flights.get(self.key(query, index_version))
+
+    @contextmanager
+    def lead(self, query, index_version, on_token=None):
+        """Registers a new flight for the duration of the block. Call flight.result.set_result when done.
+
+        If the block raises, followers get the error; if it is cancelled or ends without a
+        result, the flight is abandoned and follow returns None to them.
+        """
+        key = self.key(query, index_version)
+        flight = Flight()
+        if on_token is not None:
+            flight.subscribe(on_token)
+        self.flights[key] = flight
+        error = None
+        try:
+            yield flight
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            if not flight.result.done():
+                if error is not None and flight.followers:
+                    flight.result.set_exception(RuntimeError(f"The query being followed failed: {error}"))
+                else:
+                    flight.result.cancel()
+
+    async def follow(self, flight, on_token=None):
+        """Waits for flight to finish, forwarding its tokens to on_token.
+
+        Returns the leader's result, or None if the leader abandoned the flight.
+        """
+        flight.followers += 1
+        if on_token is not None:
+            flight.subscribe(on_token)
+        try:
+            # asyncio.wait neither cancels the result when a follower gives up, which would take
+            # the answer away from everyone else, nor raises when the leader abandons it
+            await asyncio.wait({flight.result})
+        finally:
+            if on_token is not None:
+                flight.unsubscribe(on_token)
+        if flight.result.cancelled():
+            return None
+        return flight.result.result()
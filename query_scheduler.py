@@ -0,0 +1,185 @@
+# query_scheduler.py
+import asyncio
+import itertools
+import logging
+import time
+import aiohttp
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+# Priority classes, lower runs first
+PRIORITY_INTERCOM = 0
+PRIORITY_TELEGRAM = 1
+
+class SchedulerBusy(Exception):
+    """Raised when a query arrives while the wait queue is full, or is displaced from it."""
+
+class QueryScheduler:
+    """Admission control in front of the LLM.
+
+    At most max_concurrency queries run at once and at most max_queue wait for a slot;
+    anything beyond that is rejected with SchedulerBusy instead of piling up. When the
+    queue is full, a query displaces the newest waiter of a lower priority class rather
+    than being rejected itself. Waiting queries are served by priority class, and
+    round-robin across senders within a class, so one chatty chat cannot starve everyone
+    else; a sender can also have at most max_queue_per_sender queries waiting.
+    """
+
+    def __init__(self, max_concurrency, max_queue, max_queue_per_sender=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_sender = max_queue_per_sender
+        self.running = 0
+        self.waiting = 0
+        self.queues = {}  # priority -> OrderedDict of sender -> deque of (arrival, future), in turn order
+        self.arrivals = itertools.count()
+
+    def is_full(self, priority):
+        """True if a query of this priority arriving now would be rejected."""
+        return (self.running >= self.max_concurrency and self.waiting >= self.max_queue
+                and self._newest_displaceable(priority) is None)
+
+    @asynccontextmanager
+    async def slot(self, priority, sender):
+        """Holds one of the max_concurrency slots for the duration of the block."""
+        waited = await self.acquire(priority, sender)
+        try:
+            yield waited
+        finally:
+            self.release()
+
+    async def acquire(self, priority, sender):
+        """Waits for a slot and returns the seconds spent queued. Raises SchedulerBusy if the queue is full."""
+        if self.running < self.max_concurrency and not self.waiting:
+            self.running += 1
+            return 0.0
+        senders = self.queues.setdefault(priority, OrderedDict())
+        if self.max_queue_per_sender and sender in senders:
+            queued = sum(1 for _, future in senders[sender] if not future.cancelled())
+            if queued >= self.max_queue_per_sender:
+                raise SchedulerBusy(f"{queued} queries from this sender already waiting")
+        if self.waiting >= self.max_queue:
+            victim = self._newest_displaceable(priority)
+            if victim is None:
+                raise SchedulerBusy(f"{self.waiting} queries already waiting")
+            self._displace(*victim)
+
+        future = asyncio.get_running_loop().create_future()
+        senders.setdefault(sender, deque()).append((next(self.arrivals), future))
+        self.waiting += 1
+        queued_at = time.time()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.waiting -= 1
+            elif future.exception() is None:
+                # The slot was handed over just as the caller went away, so pass it on
+                self.release()
+            raise
+        return time.time() - queued_at
+
+    def release(self):
+        self.running -= 1
+        while self.running < self.max_concurrency:
+            future = self._next_waiter()
+            if future is None:
+                break
+            self.running += 1
+            future.set_result(None)
+
+    def _next_waiter(self):
+        for priority in sorted(self.queues):
+            senders = self.queues[priority]
+            while senders:
+                sender, futures = next(iter(senders.items()))
+                _, future = futures.popleft()
+                if futures:
+                    senders.move_to_end(sender)  # Next query from this sender goes to the back of the line
+                else:
+                    del senders[sender]
+                if not future.cancelled():
+                    self.waiting -= 1
+                    return future
+        return None
+
+    def _newest_displaceable(self, priority):
+        """Returns (priority, sender, entry) for the latest arrival in the lowest class below priority."""
+        for lower in sorted(self.queues, reverse=True):
+            if lower <= priority:
+                break
+            entries = [(sender, entry) for sender, futures in self.queues[lower].items()
+                       for entry in futures if not entry[1].cancelled()]
+            if entries:
+                sender, entry = max(entries, key=lambda item: item[1][0])
+                return lower, sender, entry
+        return None
+
+    def _displace(self, priority, sender, entry):
+        """Drops a waiter from the queue and fails it with SchedulerBusy."""
+        futures = self.queues[priority][sender]
+        futures.remove(entry)
+        if not futures:
+            del self.queues[priority][sender]
+        self.waiting -= 1
+        entry[1].set_exception(SchedulerBusy("Displaced by a higher priority query"))
+
+class RemoteQueryScheduler:
+    """Stands in for QueryScheduler in HTTP worker processes, taking slots from the main process.
+
+    Each slot is a lease on the main process's scheduler, requested with POST /internal/slots
+    (which waits until one is free) and handed back with DELETE /internal/slots/<lease>. So
+    the concurrency and queue limits hold across every worker, not per worker. running and
+    waiting count this worker's own queries only.
+    """
+
+    def __init__(self, primary_url, timeout):
+        self.primary_url = primary_url
+        self.timeout = timeout
+        self.running = 0
+        self.waiting = 0
+        self.session = None
+
+    def is_full(self, priority):
+        # Only the main process knows; acquire raises SchedulerBusy when it is
+        return False
+
+    @asynccontextmanager
+    async def slot(self, priority, sender):
+        """Holds one of the main process's slots for the duration of the block."""
+        waited, lease = await self.acquire(priority, sender)
+        try:
+            yield waited
+        finally:
+            # Shielded so a cancelled query still hands its slot back
+            await asyncio.shield(self.release(lease))
+
+    async def acquire(self, priority, sender):
+        """Waits for a slot and returns (seconds spent queued, lease). Raises SchedulerBusy if none is given."""
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.waiting += 1
+        try:
+            async with self.session.post(f"{self.primary_url}/internal/slots",
+                                         json={"priority": priority, "sender": sender}) as response:
+                body = await response.json()
+                if response.status != 200:
+                    raise SchedulerBusy(body.get("error", f"Main process answered {response.status}"))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise SchedulerBusy(f"Could not get a slot from the main process: {str(e)}") from e
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        return body["waited"], body["lease"]
+
+    async def release(self, lease):
+        self.running -= 1
+        try:
+            async with self.session.delete(f"{self.primary_url}/internal/slots/{lease}") as response:
+                await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Could not hand slot {lease} back, the main process will expire it: {str(e)}")
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
@@ -0,0 +1,70 @@
+# rebuild_manager.py
+import asyncio
+import logging
+import time
+import metrics
+
+class RebuildManager:
+    """Runs vector store rebuilds in the background and hands each new QA chain to on_ready.
+
+    The current chain keeps serving while a rebuild runs. Requests that arrive during a
+    rebuild are coalesced into a single follow-up run, so content changed after the running
+    rebuild started fetching is still picked up.
+    """
+
+    def __init__(self, rebuild, on_ready):
+        self.rebuild = rebuild  # async callable returning a QA chain (or None)
+        self.on_ready = on_ready
+        self.task = None
+        self.pending = False
+        self.status = {
+            "state": "idle",
+            "runs": 0,
+            "coalesced": 0,
+            "started_at": None,
+            "finished_at": None,
+            "duration": None,
+            "last_error": None,
+        }
+
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    def request(self):
+        """Starts a rebuild, or queues one follow-up if a rebuild is already running.
+
+        Returns True if a new rebuild was started.
+        """
+        if self.is_running():
+            self.pending = True
+            self.status["coalesced"] += 1
+            self.status["state"] = "running (follow-up queued)"
+            return False
+        self.task = asyncio.create_task(self._run())
+        return True
+
+    async def _run(self):
+        while True:
+            self.pending = False
+            self.status["state"] = "running"
+            self.status["started_at"] = time.time()
+            logging.info("Background vector store rebuild started")
+            try:
+                qa_chain = await self.rebuild()
+                if qa_chain is not None:
+                    self.on_ready(qa_chain)
+                self.status["last_error"] = None
+                metrics.REBUILDS.inc(result="success")
+            except Exception as e:
+                logging.error(f"Background vector store rebuild failed: {str(e)}", exc_info=True)
+                self.status["last_error"] = str(e)
+                metrics.REBUILDS.inc(result="error")
+            finished_at = time.time()
+            self.status["runs"] += 1
+            self.status["finished_at"] = finished_at
+            self.status["duration"] = finished_at - self.status["started_at"]
+            metrics.REBUILD_SECONDS.observe(self.status["duration"])
+            logging.info(f"Background vector store rebuild finished in {self.status['duration']:.2f} seconds")
+            if not self.pending:
+                break
+        self.status["state"] = "idle"
@@ -0,0 +1,107 @@
+# retrievers.py
+from typing import Any, Callable, List
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from utils import count_tokens
+
+def document_key(doc):
+    """Identifies a chunk the same way regardless of which index returned it."""
+    return (str(doc.metadata.get("article_id")), doc.metadata.get("chunk_index"))
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=60):
+    """Merges ranked document lists, scoring each document by the sum of 1 / (rrf_k + rank)."""
+    scores = {}
+    documents = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = document_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+            documents.setdefault(key, doc)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [documents[key] for key in best]
+
+def document_tokens(doc):
+    """Uses the token count stored at index time, counting only for documents indexed without one."""
+    token_count = doc.metadata.get("token_count")
+    return token_count if token_count is not None else count_tokens(doc.page_content)
+
+def trim_to_tokens(text, max_tokens):
+    """Returns the leading words of text that add up to at most max_tokens."""
+    kept = []
+    total = 0
+    for word in text.split(" "):
+        word_tokens = count_tokens(word)
+        if total + word_tokens > max_tokens:
+            break
+        kept.append(word)
+        total += word_tokens
+    return " ".join(kept).rstrip()
+
+def fit_to_budget(documents, max_tokens, min_trim_tokens=32):
+    """Keeps documents in relevance order until max_tokens of context are used.
+
+    A document that doesn't fit is trimmed to the remaining budget if at least min_trim_tokens
+    are left, and otherwise dropped in favour of later documents that still fit whole.
+    """
+    selected = []
+    remaining = max_tokens
+    for doc in documents:
+        tokens = document_tokens(doc)
+        if tokens <= remaining:
+            selected.append(doc)
+            remaining -= tokens
+        elif remaining >= min_trim_tokens:
+            text = trim_to_tokens(doc.page_content, remaining)
+            selected.append(Document(page_content=text, metadata=dict(doc.metadata, token_count=count_tokens(text))))
+            remaining = 0
+        if remaining <= 0:
+            break
+    return selected
+
+class FlatRetriever(BaseRetriever):
+    """Vector retriever backed by a FlatIndex instead of the Chroma collection.
+
+    index_source is called on every query and returns the current FlatIndex, so live updates
+    that replace the snapshot are picked up without rebuilding the chain.
+    """
+
+    index_source: Callable[[], Any]
+    embedder: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return [doc for doc, _ in self.index_source().search(self.embedder.embed_query(query), self.k)]
+
+class HybridRetriever(BaseRetriever):
+    """Fuses vector similarity results with BM25 keyword matches using reciprocal rank fusion.
+
+    Lexical matching catches exact product names and error codes that embeddings tend to
+    blur, while the vector side still finds paraphrased questions.
+    """
+
+    vector_retriever: BaseRetriever
+    bm25_index: Any
+    k: int = 4
+    candidates: int = 20
+    rrf_k: int = 60
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        vector_docs = self.vector_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        lexical_docs = [doc for doc, _ in self.bm25_index.search(query, self.candidates)]
+        return reciprocal_rank_fusion([vector_docs, lexical_docs], self.k, self.rrf_k)
+
+class TokenBudgetRetriever(BaseRetriever):
+    """Limits the documents another retriever returns to max_tokens of context.
+
+    Prompt size drives Ollama's prefill time, so this keeps time to first token bounded no
+    matter how many or how long the retrieved chunks are.
+    """
+
+    retriever: BaseRetriever
+    max_tokens: int = 1024
+    min_trim_tokens: int = 32
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        documents = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return fit_to_budget(documents, self.max_tokens, self.min_trim_tokens)
@@ -0,0 +1,34 @@
+# startup.py
+import logging
+import time
+from contextlib import asynccontextmanager
+
+class StartupTracker:
+    """Records the state and duration of each startup phase, for the logs and /readyz."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.phases = {}  # name -> {"state", "duration"}, in the order phases started
+
+    @asynccontextmanager
+    async def phase(self, name):
+        self.phases[name] = {"state": "running", "duration": None}
+        started = time.time()
+        try:
+            yield
+        except BaseException:
+            self.phases[name] = {"state": "failed", "duration": time.time() - started}
+            raise
+        self.phases[name] = {"state": "done", "duration": time.time() - started}
+        logging.info(f"Startup phase {name} finished in {self.phases[name]['duration']:.2f} seconds")
+
+    def is_running(self, name):
+        return self.phases.get(name, {}).get("state") == "running"
+
+    def breakdown(self):
+        parts = [f"{name} {phase['duration']:.2f}s" for name, phase in self.phases.items()
+                 if phase["duration"] is not None]
+        return f"{', '.join(parts)}; total {time.time() - self.started_at:.2f}s"
+
+    def status(self):
+        return {"uptime": time.time() - self.started_at, "phases": self.phases}
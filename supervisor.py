@@ -0,0 +1,141 @@
+# supervisor.py
+import asyncio
+import logging
+import time
+import aiohttp
+
+class ProcessSupervisor:
+    """Runs a child process under asyncio and keeps it alive.
+
+    The child's combined stdout/stderr is drained line by line into on_output for as long as
+    it runs, readiness is judged by polling ready_url, and an unexpected exit triggers a
+    restart after an exponential backoff that resets once the child has stayed up for
+    stable_seconds.
+    """
+
+    def __init__(self, command, ready_url, on_output=None, on_restart=None, backoff_max=60, stable_seconds=300):
+        self.command = command
+        self.ready_url = ready_url
+        self.on_output = on_output or (lambda line: logging.info(line))
+        self.on_restart = on_restart
+        self.backoff_max = backoff_max
+        self.stable_seconds = stable_seconds
+        self.process = None
+        self.state = "stopped"
+        self.started_at = None
+        self.restarts = 0
+        self.last_restart = None
+        self.last_exit_code = None
+        self.stopping = False
+        self.backoff = 1
+        self.watch_task = None
+
+    def is_running(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        """Starts the child unless it is already running. Cuts short a pending restart backoff."""
+        if self.is_running():
+            return
+        if self.state == "restarting" and self.watch_task is not None:
+            # The watcher would otherwise spawn a second child when its backoff ends
+            self.watch_task.cancel()
+            await asyncio.gather(self.watch_task, return_exceptions=True)
+        self.stopping = False
+        await self._spawn()
+
+    async def _spawn(self):
+        self.state = "starting"
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+        )
+        self.started_at = time.time()
+        logging.info(f"Started {' '.join(self.command)} (pid {self.process.pid})")
+        self.watch_task = asyncio.create_task(self._watch(self.process))
+
+    async def _watch(self, process):
+        # Keep draining the pipe for the child's whole life so it never blocks on a full buffer.
+        # Chunked reads rather than readline(), which gives up on lines longer than 64KB.
+        pending = b""
+        while chunk := await process.stdout.read(65536):
+            *lines, pending = (pending + chunk).split(b"\n")
+            for line in lines:
+                self.on_output(line.decode('utf-8', errors='replace').rstrip())
+        if pending:
+            self.on_output(pending.decode('utf-8', errors='replace').rstrip())
+        exit_code = await process.wait()
+        self.last_exit_code = exit_code
+        if self.stopping or process is not self.process:
+            return
+
+        uptime = time.time() - self.started_at
+        if uptime > self.stable_seconds:
+            self.backoff = 1
+        self.state = "restarting"
+        logging.error(f"Bot exited with code {exit_code} after {uptime:.0f}s, restarting in {self.backoff}s")
+        await asyncio.sleep(self.backoff)
+        self.backoff = min(self.backoff * 2, self.backoff_max)
+        if self.stopping or process is not self.process:
+            return
+        self.restarts += 1
+        self.last_restart = time.time()
+        await self._spawn()
+        if self.on_restart is not None:
+            self.on_restart()
+
+    async def probe(self):
+        """Returns True if the child's readiness endpoint answers 200."""
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2)) as session:
+                async with session.get(self.ready_url) as response:
+                    return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def wait_ready(self, timeout):
+        """Polls the readiness endpoint until it answers 200. Returns False on timeout or if the child exits."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if await self.probe():
+                self.state = "running"
+                return True
+            if not self.is_running() and self.state != "restarting":
+                return False
+            await asyncio.sleep(1)
+        return False
+
+    async def stop(self, timeout=15):
+        """Stops the child with SIGTERM, falling back to SIGKILL after timeout seconds."""
+        if self.state == "restarting" and self.watch_task is not None:
+            self.watch_task.cancel()  # The child is already gone; skip the rest of the backoff
+        self.stopping = True
+        self.state = "stopping"
+        process = self.process
+        if process is not None and process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Bot did not stop within {timeout}s, killing it")
+                process.kill()
+                await process.wait()
+        if self.watch_task is not None:
+            await asyncio.gather(self.watch_task, return_exceptions=True)
+        self.state = "stopped"
+        self.backoff = 1
+
+    async def refresh_state(self):
+        """Re-checks readiness so state reflects whether the child is actually serving."""
+        if self.is_running() and self.state in ("running", "starting", "not ready"):
+            self.state = "running" if await self.probe() else "not ready"
+        return self.state
+
+    def status(self):
+        return {
+            "state": self.state,
+            "pid": self.process.pid if self.is_running() else None,
+            "uptime": time.time() - self.started_at if self.is_running() else 0,
+            "restarts": self.restarts,
+            "last_restart": self.last_restart,
+            "last_exit_code": self.last_exit_code,
+        }
@@ -0,0 +1,91 @@
+# supplemental_store.py
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+SUPPLEMENTAL_STORE_PATH = os.getenv('SUPPLEMENTAL_STORE_PATH', 'supplemental_info.jsonl')
+LEGACY_SUPPLEMENTAL_PATH = 'supplemental_info.json'
+# Every supplemental id starts with this, which keeps them apart from Intercom article ids in the index
+ID_PREFIX = "supplemental_"
+
+def normalize_question(question):
+    return " ".join(question.lower().split())
+
+def entry_id(question):
+    """Derives a stable id from the question, so re-adding a question edits the existing entry."""
+    return ID_PREFIX + hashlib.sha1(normalize_question(question).encode('utf-8')).hexdigest()[:16]
+
+class SupplementalStore:
+    """Append-only JSONL log of supplemental Q&A entries.
+
+    Every change is one appended line, either {"op": "put", "id", "question", "answer",
+    "updated_at"} or {"op": "delete", "id", "updated_at"}, and the current entries are the
+    log replayed with the last write winning. Appends are single writes to a file opened in
+    append mode and fsynced, so the admin bot and the main bot can both add entries safely.
+    """
+
+    def __init__(self, path=SUPPLEMENTAL_STORE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _append(self, event):
+        line = json.dumps(event, separators=(',', ':')) + "\n"
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def put(self, question, answer, supplemental_id=None):
+        """Adds or replaces an entry and returns it. Pass supplemental_id to edit an entry's question."""
+        entry = {
+            "op": "put",
+            "id": supplemental_id or entry_id(question),
+            "question": question,
+            "answer": answer,
+            "updated_at": int(time.time()),
+        }
+        self._append(entry)
+        return entry
+
+    def delete(self, supplemental_id):
+        self._append({"op": "delete", "id": supplemental_id, "updated_at": int(time.time())})
+
+    def load(self):
+        """Replays the log into {id: entry}, in first-added order."""
+        self.migrate_legacy()
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # Most likely a write cut short by a crash; everything before it is still good
+                    logging.warning(f"Skipping unreadable line {number} of {self.path}")
+                    continue
+                if event.get("op") == "delete":
+                    entries.pop(event["id"], None)
+                else:
+                    entries[event["id"]] = event
+        return entries
+
+    def migrate_legacy(self):
+        """Imports supplemental_info.json into the log the first time the log is used."""
+        if os.path.exists(self.path) or not os.path.exists(LEGACY_SUPPLEMENTAL_PATH):
+            return
+        try:
+            with open(LEGACY_SUPPLEMENTAL_PATH, 'r') as f:
+                legacy = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read {LEGACY_SUPPLEMENTAL_PATH}: {str(e)}")
+            return
+        for item in legacy:
+            self.put(item["question"], item["answer"])
+        logging.info(f"Imported {len(legacy)} entries from {LEGACY_SUPPLEMENTAL_PATH} into {self.path}")
@@ -1,44 +1,279 @@
 # telegram_bot.py
 from telethon import TelegramClient, events
+import asyncio
 import logging
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from langchain_core.callbacks import BaseCallbackHandler
+import metrics
+import vector_store
+from utils import count_tokens
+from answer_cache import SemanticAnswerCache
+from query_coalescer import QueryCoalescer
+from query_scheduler import PRIORITY_TELEGRAM, QueryScheduler, SchedulerBusy
+
+# How many queries may run against the QA chain at once
+QUERY_CONCURRENCY = int(os.getenv('QUERY_CONCURRENCY', '2'))
+# How many queries may wait for a free slot before new ones are turned away
+QUERY_QUEUE_SIZE = int(os.getenv('QUERY_QUEUE_SIZE', '32'))
+# How many of those a single chat or Intercom conversation may hold
+QUERY_QUEUE_PER_SENDER = int(os.getenv('QUERY_QUEUE_PER_SENDER', '4'))
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '256'))
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', '0.95'))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', '3600'))
+# Minimum seconds between edits of a streaming Telegram answer, to stay clear of flood limits
+TELEGRAM_EDIT_INTERVAL = float(os.getenv('TELEGRAM_EDIT_INTERVAL', '1.5'))
 
 qa_chain = None 
+# qa_chain.invoke blocks for the whole retrieval + generation, so it runs here instead of on the event loop
+query_executor = ThreadPoolExecutor(max_workers=QUERY_CONCURRENCY, thread_name_prefix='query')
+answer_cache = SemanticAnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL)
+query_scheduler = QueryScheduler(QUERY_CONCURRENCY, QUERY_QUEUE_SIZE, QUERY_QUEUE_PER_SENDER)
+query_coalescer = QueryCoalescer()
+metrics.QUEUE_DEPTH.set_function(lambda: query_scheduler.waiting)
+metrics.IN_FLIGHT.set_function(lambda: query_scheduler.running)
+metrics.ANSWER_CACHE_HIT_RATIO.set_function(answer_cache.hit_rate)
+
+BUSY_RESPONSE = "I'm busy answering other questions right now, please try again in a moment."
+WARMING_UP_RESPONSE = "I'm still warming up and loading the knowledge base, please try again in a moment."
+
+class TokenStreamHandler(BaseCallbackHandler):
+    """Forwards LLM tokens from the query thread to a callback on the event loop.
+
+    Also records when retrieval and the LLM call start and end, for the latency metrics, and
+    how large the prompt was.
+    """
+
+    def __init__(self, loop, on_token):
+        self.loop = loop
+        self.on_token = on_token
+        self.retrieval_start_time = None
+        self.retrieval_end_time = None
+        self.llm_start_time = None
+        self.first_token_time = None
+        self.prompt_tokens = None
+        self.context_chunks = None
+
+    def on_retriever_start(self, serialized, query, **kwargs):
+        # Nested retrievers (the hybrid one wraps a vector retriever) report too; keep the outermost span
+        if self.retrieval_start_time is None:
+            self.retrieval_start_time = time.time()
+
+    def on_retriever_end(self, documents, **kwargs):
+        # The outermost retriever finishes last, so this ends up holding what went into the prompt
+        self.retrieval_end_time = time.time()
+        self.context_chunks = len(documents)
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.llm_start_time = time.time()
+        self.prompt_tokens = sum(count_tokens(prompt) for prompt in prompts)
+
+    def observe(self, end_time):
+        if self.retrieval_start_time is not None and self.retrieval_end_time is not None:
+            metrics.RETRIEVAL_SECONDS.observe(self.retrieval_end_time - self.retrieval_start_time)
+        if self.llm_start_time is not None and self.first_token_time is not None:
+            metrics.TIME_TO_FIRST_TOKEN_SECONDS.observe(self.first_token_time - self.llm_start_time)
+            metrics.GENERATION_SECONDS.observe(end_time - self.first_token_time)
+        if self.prompt_tokens is not None:
+            metrics.PROMPT_TOKENS.observe(self.prompt_tokens)
 
-async def start_telegram_client(api_id, api_hash, bot_token, qa_chain_instance):
+    def on_llm_new_token(self, token, **kwargs):
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+        if self.on_token is not None:
+            self.loop.call_soon_threadsafe(self.on_token, token)
+
+def set_qa_chain(qa_chain_instance):
+    """Swaps in a new QA chain. Queries already running finish on the chain they started with."""
     global qa_chain
     qa_chain = qa_chain_instance
 
-    client = TelegramClient('logs/tg_chat', api_id, api_hash)
+async def answer_query(event):
+    """Answers a `.x <question>` message, streaming the answer into an edited reply.
+
+    Returns the handle_query result. Only needs event.pattern_match, event.chat_id and
+    event.respond, so the load test can drive it with a stand-in event.
+    """
+    query = event.pattern_match.group(1)
+    logging.info(f"Received query: {query}")
+    message = await event.respond("`...`", parse_mode='Markdown')
+    tokens = []
 
-    @client.on(events.NewMessage(pattern=r'^\.x (.+)', func=lambda e: e.text.lower().startswith('.x ')))
-    async def answer_query(event):
-        query = event.pattern_match.group(1)
-        logging.info(f"Received query: {query}")
-        result = await handle_query(query)
-        response = result["response"]
-        time_taken = result["time_taken"]
-        await event.respond(f"`{response}`\n**Time to generate: {time_taken:.2f} seconds**", parse_mode='Markdown')
+    async def stream_edits():
+        shown = ""
+        while True:
+            await asyncio.sleep(TELEGRAM_EDIT_INTERVAL)
+            text = "".join(tokens).strip()
+            if text and text != shown:
+                try:
+                    await message.edit(f"`{text}`", parse_mode='Markdown')
+                    shown = text
+                except Exception as e:
+                    logging.debug(f"Skipping streaming edit: {str(e)}")
+
+    editor = asyncio.create_task(stream_edits())
+    try:
+        result = await handle_query(query, on_token=tokens.append, priority=PRIORITY_TELEGRAM,
+                                    sender=f"telegram:{event.chat_id}")
+    finally:
+        editor.cancel()
+    response = result["response"]
+    if result.get("busy") or result.get("warming_up"):
+        await message.edit(f"`{response}`", parse_mode='Markdown')
+        return result
+    time_taken = result["time_taken"]
+    time_to_first_token = result.get("time_to_first_token", time_taken)
+    await message.edit(
+        f"`{response}`\n**Time to first token: {time_to_first_token:.2f} seconds**"
+        f"\n**Time to generate: {time_taken:.2f} seconds**",
+        parse_mode='Markdown'
+    )
+    return result
+
+async def start_telegram_client(api_id, api_hash, bot_token, qa_chain_instance=None):
+    """Connects the bot. Without a chain yet, queries get a warming-up reply until set_qa_chain is called."""
+    if qa_chain_instance is not None:
+        set_qa_chain(qa_chain_instance)
+
+    client = TelegramClient('logs/tg_chat', api_id, api_hash)
+    client.add_event_handler(
+        answer_query, events.NewMessage(pattern=r'^\.x (.+)', func=lambda e: e.text.lower().startswith('.x '))
+    )
 
     await client.start(bot_token=bot_token)
     logging.info("Telegram client connected.")
 
     return client
 
-async def handle_query(query):
-    if qa_chain is None:
-        logging.error("QA chain is not initialized.")
-        return {"response": "Initialization error: Vector store not available. Check log for details.", "time_taken": 0}
+async def handle_query(query, on_token=None, priority=PRIORITY_TELEGRAM, sender=None):
+    """Answers query with the QA chain.
+
+    on_token, if given, is called on the event loop with each generated token as it arrives
+    (or once with the whole answer on a cache hit). Cache misses wait for a query_scheduler
+    slot in the given priority class, taking turns with other senders; when the queue is full
+    the result has "busy" set and nothing is generated. A query identical to one already being
+    answered follows that one instead of generating again, and its result has "coalesced" set.
+    If the query it follows is abandoned, it is answered here instead, and on_token only gets
+    the tokens past those it was already given. Until the first QA chain is set the result has
+    "warming_up" set instead.
+    """
+    chain = qa_chain  # Hold on to one chain for the whole query in case a rebuild swaps it
+    if chain is None:
+        logging.warning("QA chain is not initialized yet, answering with a warming-up message.")
+        metrics.QUERIES.inc(outcome="warming_up")
+        return {"response": WARMING_UP_RESPONSE, "time_taken": 0, "warming_up": True}
 
     start_time = time.time()
+    loop = asyncio.get_running_loop()
+    index_version = vector_store.index_version
+    delivered = 0  # Tokens passed to on_token so far, possibly by a generation that was since abandoned
+
+    def stream():
+        """Returns the token callback for one generation, skipping the tokens earlier ones delivered."""
+        position = 0
+
+        def forward(token):
+            nonlocal position, delivered
+            position += 1
+            if position > delivered:
+                delivered += 1
+                if on_token is not None:
+                    on_token(token)
+        return forward
+
+    try:
+        # Embedding goes through the embedding cache, so the retriever's own lookup is nearly free
+        query_embedding = await loop.run_in_executor(None, vector_store.get_embedder().embed_query, query)
+        metrics.QUERY_EMBEDDING_SECONDS.observe(time.time() - start_time)
+        cached = answer_cache.lookup(query, query_embedding, index_version)
+        metrics.ANSWER_CACHE_LOOKUPS.inc(result="miss" if cached is None else "hit")
+        if cached is not None:
+            response, similarity = cached
+            logging.info(f"Answer cache hit (similarity {similarity:.3f}, hit rate {answer_cache.hit_rate():.0%})")
+            if on_token is not None:
+                on_token(response)
+            time_taken = time.time() - start_time
+            metrics.QUERIES.inc(outcome="cached")
+            metrics.QUERY_SECONDS.observe(time_taken)
+            return {"response": response, "time_taken": time_taken, "time_to_first_token": time_taken, "cached": True}
+
+        # When the leader gives up, e.g. because its client disconnected, the first follower to
+        # notice leads a new generation and the others follow that one
+        while (flight := query_coalescer.get(query, index_version)) is not None:
+            result = await follow_query(flight, stream(), start_time)
+            if result is not None:
+                return result
+            logging.info("The identical query being followed was abandoned, answering it here instead")
+    except Exception as e:
+        logging.error(f"Error during query handling: {str(e)}")
+        metrics.QUERIES.inc(outcome="error")
+        return {"response": "An error occurred while processing the query.", "time_taken": 0}
+
+    with query_coalescer.lead(query, index_version, stream()) as flight:
+        result = await generate_answer(chain, query, query_embedding, index_version, flight.publish,
+                                       priority, sender, start_time)
+        flight.result.set_result(result)
+    return result
+
+async def follow_query(flight, on_token, start_time):
+    """Waits for an identical query that is already being answered and returns its answer as this query's.
+
+    Returns None if that query was abandoned before it finished.
+    """
+    first_token_time = None
+
+    def forward(token):
+        nonlocal first_token_time
+        if first_token_time is None:
+            first_token_time = time.time()
+        if on_token is not None:
+            on_token(token)
+
+    logging.info(f"Identical query already in flight, sharing its answer ({flight.followers + 1} waiting)")
+    result = await query_coalescer.follow(flight, forward)
+    if result is None:
+        return None
+    end_time = time.time()
+    time_taken = end_time - start_time
+    if result.get("busy"):
+        metrics.QUERIES.inc(outcome="rejected")
+    else:
+        metrics.QUERIES.inc(outcome="coalesced")
+        metrics.QUERY_SECONDS.observe(time_taken)
+    return dict(result, time_taken=time_taken, time_to_first_token=(first_token_time or end_time) - start_time,
+                coalesced=True)
+
+async def generate_answer(chain, query, query_embedding, index_version, on_token, priority, sender, start_time):
+    """Runs query through the chain once a scheduler slot is free, and caches the answer."""
+    loop = asyncio.get_running_loop()
+    stream_handler = TokenStreamHandler(loop, on_token)
     try:
-        result = qa_chain.invoke(query)
+        async with query_scheduler.slot(priority, sender) as waited:
+            metrics.QUEUE_WAIT_SECONDS.observe(waited)
+            if waited:
+                logging.info(f"Query waited {waited:.2f}s for a free slot")
+            result = await loop.run_in_executor(
+                query_executor, partial(chain.invoke, query, config={"callbacks": [stream_handler]})
+            )
+    except SchedulerBusy as e:
+        logging.warning(f"Rejecting query, scheduler is busy: {str(e)}")
+        metrics.QUERIES.inc(outcome="rejected")
+        return {"response": BUSY_RESPONSE, "time_taken": time.time() - start_time, "busy": True}
     except Exception as e:
         logging.error(f"Error during query handling: {str(e)}")
+        metrics.QUERIES.inc(outcome="error")
         return {"response": "An error occurred while processing the query.", "time_taken": 0}
 
     end_time = time.time()
     time_taken = end_time - start_time
+    time_to_first_token = (stream_handler.first_token_time or end_time) - start_time
+    stream_handler.observe(end_time)
+    metrics.QUERIES.inc(outcome="answered")
+    metrics.QUERY_SECONDS.observe(time_taken)
+    logging.info(f"Prompt: {stream_handler.prompt_tokens} tokens with {stream_handler.context_chunks} context chunks")
+    logging.info(f"Time to first token: {time_to_first_token:.2f}s, time to generate: {time_taken:.2f}s")
 
     logging.info(f"Query result: {result}")
 
@@ -51,5 +286,7 @@ async def handle_query(query):
 
     if not result:
         result = "I apologize, but I don't have enough information to provide a helpful answer."
+    else:
+        answer_cache.store(query, query_embedding, result, index_version)
 
-    return {"response": result, "time_taken": time_taken}
+    return {"response": result, "time_taken": time_taken, "time_to_first_token": time_to_first_token, "cached": False}
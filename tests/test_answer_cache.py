@@ -0,0 +1,52 @@
+# test_answer_cache.py
+"""Tests lookups, expiry and eviction in SemanticAnswerCache.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import answer_cache
+from answer_cache import SemanticAnswerCache
+
+class SemanticAnswerCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = SemanticAnswerCache(max_entries=2, similarity_threshold=0.9, ttl_seconds=60)
+
+    def test_same_query_hits_regardless_of_case_and_spacing(self):
+        self.cache.store("How do I export?", [1, 0], "Use the export button.", 1)
+        self.assertEqual(self.cache.lookup("how do i  EXPORT?", [0, 1], 1), ("Use the export button.", 1.0))
+
+    def test_similar_embedding_hits_above_the_threshold_only(self):
+        self.cache.store("How do I export?", [1, 0], "Use the export button.", 1)
+        response, similarity = self.cache.lookup("Exporting data", [0.99, 0.1], 1)
+        self.assertEqual(response, "Use the export button.")
+        self.assertGreater(similarity, 0.9)
+        self.assertIsNone(self.cache.lookup("Deleting data", [0.5, 0.5], 1))
+        self.assertEqual(self.cache.hit_rate(), 0.5)
+
+    def test_entries_from_another_index_version_are_dropped(self):
+        self.cache.store("How do I export?", [1, 0], "Old answer.", 1)
+        self.assertIsNone(self.cache.lookup("How do I export?", [1, 0], 2))
+        self.assertEqual(len(self.cache.entries), 0)
+
+    def test_entries_expire_after_the_ttl(self):
+        with mock.patch.object(answer_cache.time, 'time', return_value=1000):
+            self.cache.store("How do I export?", [1, 0], "Use the export button.", 1)
+        with mock.patch.object(answer_cache.time, 'time', return_value=1061):
+            self.assertIsNone(self.cache.lookup("How do I export?", [1, 0], 1))
+
+    def test_evicts_the_least_recently_used_entry(self):
+        self.cache.store("first", [1, 0], "1", 1)
+        self.cache.store("second", [0, 1], "2", 1)
+        self.cache.lookup("first", [1, 0], 1)
+        self.cache.store("third", [-1, 0], "3", 1)
+        self.assertEqual(list(self.cache.entries), ["first", "third"])
+
+if __name__ == '__main__':
+    unittest.main()
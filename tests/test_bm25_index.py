@@ -0,0 +1,62 @@
+# test_bm25_index.py
+"""Tests tokenizing, scoring and incremental updates in BM25Index.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from bm25_index import BM25Index, tokenize
+
+class TokenizeTest(unittest.TestCase):
+    def test_keeps_compound_terms_whole_and_split(self):
+        self.assertEqual(tokenize("Error ERR-1042 in v2.3"),
+                         ["error", "err-1042", "err", "1042", "in", "v2.3", "v2", "3"])
+
+class BM25IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = BM25Index()
+        self.index.add("export", "How to export your contacts to CSV", {"article_id": "1"})
+        self.index.add("invoice", "Download an invoice from the billing page", {"article_id": "2"})
+        self.index.add("error", "Fixing error ERR-1042 when you export invoices", {"article_id": "3"})
+
+    def ids(self, results):
+        return [doc.metadata["article_id"] for doc, _ in results]
+
+    def test_ranks_matching_documents_best_first(self):
+        results = self.index.search("export contacts", 3)
+        self.assertEqual(self.ids(results), ["1", "3"])
+        self.assertGreater(results[0][1], results[1][1])
+
+    def test_matches_compound_terms(self):
+        self.assertEqual(self.ids(self.index.search("err-1042", 3)), ["3"])
+
+    def test_limits_results_to_k(self):
+        self.assertEqual(len(self.index.search("export invoice", 1)), 1)
+
+    def test_no_results_for_unknown_terms(self):
+        self.assertEqual(self.index.search("refund", 3), [])
+
+    def test_replacing_a_document_drops_its_old_terms(self):
+        self.index.add("export", "Share contacts with your team", {"article_id": "1"})
+        self.assertEqual(self.ids(self.index.search("csv", 3)), [])
+        self.assertEqual(self.ids(self.index.search("share", 3)), ["1"])
+        self.assertEqual(self.index.total_length, sum(self.index.doc_lengths.values()))
+
+    def test_remove(self):
+        self.index.remove("error")
+        self.index.remove("missing")
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.ids(self.index.search("err", 3)), [])
+        self.assertNotIn("err", self.index.postings)
+        self.assertEqual(self.index.total_length, sum(self.index.doc_lengths.values()))
+
+    def test_empty_index(self):
+        self.assertEqual(BM25Index().search("export", 3), [])
+
+if __name__ == '__main__':
+    unittest.main()
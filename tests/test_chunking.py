@@ -0,0 +1,47 @@
+# test_chunking.py
+"""Tests how vector_store.chunk_text splits article text into overlapping chunks.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from utils import count_tokens
+from vector_store import chunk_text
+
+FIRST = "one two three four five six seven eight nine ten eleven twelve."
+SECOND = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu."
+
+class ChunkTextTest(unittest.TestCase):
+    def test_short_text_is_one_chunk(self):
+        self.assertEqual(chunk_text(f"{FIRST}\n\n{SECOND}", max_tokens=40, overlap_tokens=4), [f"{FIRST}\n{SECOND}"])
+
+    def test_next_chunk_starts_with_the_end_of_the_previous_one(self):
+        chunks = chunk_text(f"{FIRST}\n{SECOND}", max_tokens=20, overlap_tokens=4)
+        self.assertEqual(chunks, [FIRST, f"ten eleven twelve.\n{SECOND}"])
+
+    def test_no_overlap_when_disabled(self):
+        self.assertEqual(chunk_text(f"{FIRST}\n{SECOND}", max_tokens=20, overlap_tokens=0), [FIRST, SECOND])
+
+    def test_heading_starts_a_new_chunk_without_overlap(self):
+        chunks = chunk_text(f"{FIRST}\nBilling settings\n{SECOND}", max_tokens=20, overlap_tokens=4)
+        self.assertEqual(chunks, [FIRST, f"Billing settings\n{SECOND}"])
+
+    def test_heading_stays_with_a_short_chunk(self):
+        chunks = chunk_text(f"Getting started\nBilling settings\n{SECOND}", max_tokens=40, overlap_tokens=4)
+        self.assertEqual(chunks, [f"Getting started\nBilling settings\n{SECOND}"])
+
+    def test_long_paragraph_is_split_within_the_limit(self):
+        text = " ".join(f"w{i}" for i in range(50)) + "."
+        chunks = chunk_text(text, max_tokens=20, overlap_tokens=4)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(count_tokens(chunk) <= 20 for chunk in chunks))
+        self.assertEqual(chunks[1].split()[0], "w12")
+        self.assertTrue(chunks[-1].endswith("w49."))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# test_data_processor.py
+"""Tests Intercom paging in data_processor against a local stub of the /articles endpoint.
+
+    python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import data_processor
+
+class StubIntercom:
+    """Serves articles newest first, page_size at a time, with scripted failures per page.
+
+    failures maps a page number to a list of responses to give before the real one: an int
+    status code, or "slow" to hang past the client timeout.
+    """
+
+    def __init__(self, articles, page_size):
+        self.articles = sorted(articles, key=lambda article: article['updated_at'], reverse=True)
+        self.page_size = page_size
+        self.failures = {}
+        self.requests = []
+
+    async def list_articles(self, request):
+        page = int(request.query['page'])
+        self.requests.append(page)
+        failures = self.failures.get(page)
+        if failures:
+            failure = failures.pop(0)
+            if failure == "slow":
+                await asyncio.sleep(1)
+            else:
+                return web.json_response({}, status=failure, headers={'Retry-After': '0.2'})
+        total_pages = max(1, -(-len(self.articles) // self.page_size))
+        start = (page - 1) * self.page_size
+        return web.json_response({"data": self.articles[start:start + self.page_size],
+                                  "pages": {"page": page, "total_pages": total_pages}})
+
+def make_articles(count):
+    return [{"id": str(i), "title": f"Article {i}", "body": "<p>Body</p>", "updated_at": 1000 + i}
+            for i in range(count)]
+
+class IterArticlePagesTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.stub = StubIntercom(make_articles(12), page_size=5)
+        app = web.Application()
+        app.router.add_get('/articles', self.stub.list_articles)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.patches = [
+            mock.patch.object(data_processor, 'INTERCOM_API_URL', f"http://127.0.0.1:{port}"),
+            mock.patch.object(data_processor, 'INTERCOM_PAGE_SIZE', 5),
+            mock.patch.object(data_processor, 'INTERCOM_FETCH_CONCURRENCY', 1),
+            mock.patch.object(data_processor, 'INTERCOM_MAX_RETRIES', 2),
+            mock.patch.object(data_processor, 'INTERCOM_REQUEST_TIMEOUT', 0.2),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    async def asyncTearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        await self.runner.cleanup()
+
+    async def collect(self, changed_since=None):
+        pages = []
+        async for articles in data_processor.iter_article_pages("token", changed_since):
+            pages.append([article["id"] for article in articles])
+        return pages
+
+    async def test_pages_through_every_article(self):
+        with mock.patch.object(data_processor, 'INTERCOM_FETCH_CONCURRENCY', 2):
+            pages = await self.collect()
+        self.assertEqual([len(page) for page in pages], [5, 5, 2])
+        self.assertEqual([article_id for page in pages for article_id in page],
+                         [str(i) for i in range(11, -1, -1)])
+
+    async def test_retries_after_429_honouring_retry_after(self):
+        self.stub.failures[2] = [429]
+        started = time.monotonic()
+        pages = await self.collect()
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(self.stub.requests, [1, 2, 2, 3])
+        self.assertEqual(sum(len(page) for page in pages), 12)
+
+    async def test_retries_timed_out_requests(self):
+        self.stub.failures[1] = ["slow"]
+        pages = await self.collect()
+        self.assertEqual(self.stub.requests, [1, 1, 2, 3])
+        self.assertEqual(sum(len(page) for page in pages), 12)
+
+    async def test_changed_since_stops_at_first_unchanged_page(self):
+        # Page 1 holds articles updated at 1011-1007, page 2 at 1006-1002
+        pages = await self.collect(changed_since=1006)
+        self.assertEqual(self.stub.requests, [1, 2])
+        self.assertEqual(len(pages), 2)
+
+    async def test_raises_when_a_page_keeps_failing(self):
+        self.stub.failures[2] = [500, 500, 500]
+        with mock.patch.object(data_processor, 'retry_delay', lambda response, backoff: 0):
+            with self.assertRaises(RuntimeError):
+                await self.collect()
+
+if __name__ == '__main__':
+    unittest.main()
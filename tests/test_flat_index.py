@@ -0,0 +1,80 @@
+# test_flat_index.py
+"""Tests saving, loading and searching FlatIndex snapshots.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from flat_index import FlatIndex
+
+IDS = ["a", "b", "c"]
+EMBEDDINGS = [[3, 0], [0, 2], [1, 1]]
+DOCUMENTS = ["first", "second", "third"]
+METADATAS = [{"article_id": "1"}, {"article_id": "2"}, {"article_id": "3"}]
+
+class StubStore:
+    def __init__(self, ids, embeddings, documents, metadatas):
+        self.existing = {"ids": ids, "embeddings": embeddings, "documents": documents, "metadatas": metadatas}
+
+    def get(self, include):
+        return self.existing
+
+class FlatIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "flat", "index.npy")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        FlatIndex.write(self.path, IDS, EMBEDDINGS, DOCUMENTS, METADATAS)
+        index = FlatIndex.load(self.path)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.ids, IDS)
+        self.assertEqual(index.documents, DOCUMENTS)
+        self.assertEqual(index.metadatas, METADATAS)
+        self.assertIsInstance(index.matrix, np.memmap)
+        np.testing.assert_allclose(np.linalg.norm(index.matrix, axis=1), 1, rtol=1e-6)
+        self.assertFalse(os.path.exists(f"{self.path}.tmp"))
+
+    def test_search_ranks_by_cosine_similarity(self):
+        FlatIndex.write(self.path, IDS, EMBEDDINGS, DOCUMENTS, METADATAS)
+        results = FlatIndex.load(self.path).search([1, 0.2], 2)
+        self.assertEqual([doc.page_content for doc, _ in results], ["first", "third"])
+        self.assertAlmostEqual(results[0][1], 1 / np.hypot(1, 0.2), places=5)
+        self.assertEqual(results[0][0].metadata, {"article_id": "1"})
+
+    def test_rewrite_replaces_the_snapshot(self):
+        FlatIndex.write(self.path, IDS, EMBEDDINGS, DOCUMENTS, METADATAS)
+        FlatIndex.write(self.path, ["d"], [[0, 1]], ["fourth"], [{"article_id": "4"}])
+        index = FlatIndex.load(self.path)
+        self.assertEqual(index.ids, ["d"])
+        self.assertEqual(index.search([0, 1], 3)[0][0].page_content, "fourth")
+
+    def test_load_rejects_mismatched_files(self):
+        FlatIndex.write(self.path, IDS, EMBEDDINGS, DOCUMENTS, METADATAS)
+        np.save(self.path, np.zeros((2, 2), dtype=np.float32))
+        with self.assertRaises(ValueError):
+            FlatIndex.load(self.path)
+
+    def test_from_store(self):
+        index = FlatIndex.from_store(StubStore(IDS, EMBEDDINGS, DOCUMENTS, METADATAS), self.path)
+        self.assertEqual(index.ids, IDS)
+        self.assertTrue(os.path.exists(f"{self.path}.meta.json"))
+
+    def test_empty_store(self):
+        index = FlatIndex.from_store(StubStore([], [], [], []), self.path)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.search([1, 0], 3), [])
+
+if __name__ == '__main__':
+    unittest.main()
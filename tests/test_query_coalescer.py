@@ -0,0 +1,88 @@
+# test_query_coalescer.py
+"""Tests sharing one generation between identical in-flight queries with QueryCoalescer.
+
+    python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from query_coalescer import QueryCoalescer
+
+class QueryCoalescerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.coalescer = QueryCoalescer()
+
+    async def test_matches_queries_by_normalized_text_and_index_version(self):
+        with self.coalescer.lead("How do I  Export?", 1) as flight:
+            self.assertIs(self.coalescer.get("how do i export?", 1), flight)
+            self.assertIsNone(self.coalescer.get("how do i export?", 2))
+            flight.result.set_result("answer")
+        self.assertIsNone(self.coalescer.get("how do i export?", 1))
+
+    async def test_follower_gets_earlier_and_later_tokens_and_the_result(self):
+        tokens = []
+        with self.coalescer.lead("q", 1) as flight:
+            flight.publish("a")
+            follower = asyncio.create_task(self.coalescer.follow(flight, tokens.append))
+            await asyncio.sleep(0)
+            flight.publish("b")
+            flight.result.set_result({"response": "ab"})
+        self.assertEqual(await follower, {"response": "ab"})
+        self.assertEqual(tokens, ["a", "b"])
+        self.assertEqual(flight.listeners, [])
+
+    async def test_cancelled_follower_leaves_the_result_to_the_others(self):
+        with self.coalescer.lead("q", 1) as flight:
+            leaving = asyncio.create_task(self.coalescer.follow(flight))
+            staying = asyncio.create_task(self.coalescer.follow(flight))
+            await asyncio.sleep(0)
+            leaving.cancel()
+            await asyncio.sleep(0)
+            flight.result.set_result("answer")
+        self.assertEqual(await staying, "answer")
+        self.assertTrue(leaving.cancelled())
+
+    async def test_cancelled_leader_abandons_the_flight(self):
+        started = asyncio.Event()
+
+        async def lead():
+            with self.coalescer.lead("q", 1) as flight:
+                started.set()
+                await asyncio.sleep(10)
+                flight.result.set_result("never")
+
+        leader = asyncio.create_task(lead())
+        await started.wait()
+        follower = asyncio.create_task(self.coalescer.follow(self.coalescer.get("q", 1)))
+        await asyncio.sleep(0)
+        leader.cancel()
+        self.assertIsNone(await follower)
+        self.assertIsNone(self.coalescer.get("q", 1))
+
+    async def test_failed_leader_fails_its_followers(self):
+        started = asyncio.Event()
+        followed = asyncio.Event()
+
+        async def lead():
+            with self.coalescer.lead("q", 1):
+                started.set()
+                await followed.wait()
+                raise ValueError("boom")
+
+        leader = asyncio.create_task(lead())
+        await started.wait()
+        follower = asyncio.create_task(self.coalescer.follow(self.coalescer.get("q", 1)))
+        await asyncio.sleep(0)
+        followed.set()
+        with self.assertRaises(ValueError):
+            await leader
+        with self.assertRaises(RuntimeError):
+            await follower
+
+if __name__ == '__main__':
+    unittest.main()
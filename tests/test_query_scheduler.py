@@ -0,0 +1,117 @@
+# test_query_scheduler.py
+"""Tests admission, displacement, per-sender limits and slot hand-off in QueryScheduler.
+
+    python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from query_scheduler import PRIORITY_INTERCOM, PRIORITY_TELEGRAM, QueryScheduler, SchedulerBusy
+
+class QuerySchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def wait_for(self, scheduler, priority, sender):
+        """Starts a query that has to queue, and lets it reach the queue."""
+        task = asyncio.create_task(scheduler.acquire(priority, sender))
+        await asyncio.sleep(0)
+        self.assertFalse(task.done())
+        return task
+
+    async def test_runs_immediately_while_slots_are_free(self):
+        scheduler = QueryScheduler(max_concurrency=2, max_queue=1)
+        self.assertEqual(await scheduler.acquire(PRIORITY_TELEGRAM, "a"), 0.0)
+        self.assertEqual(await scheduler.acquire(PRIORITY_TELEGRAM, "b"), 0.0)
+        self.assertEqual(scheduler.running, 2)
+
+    async def test_rejects_when_the_queue_is_full(self):
+        scheduler = QueryScheduler(max_concurrency=1, max_queue=1)
+        await scheduler.acquire(PRIORITY_TELEGRAM, "a")
+        await self.wait_for(scheduler, PRIORITY_TELEGRAM, "b")
+        self.assertTrue(scheduler.is_full(PRIORITY_TELEGRAM))
+        with self.assertRaises(SchedulerBusy):
+            await scheduler.acquire(PRIORITY_TELEGRAM, "c")
+
+    async def test_higher_priority_displaces_the_newest_lower_priority_waiter(self):
+        scheduler = QueryScheduler(max_concurrency=1, max_queue=2)
+        await scheduler.acquire(PRIORITY_TELEGRAM, "a")
+        older = await self.wait_for(scheduler, PRIORITY_TELEGRAM, "b")
+        newer = await self.wait_for(scheduler, PRIORITY_TELEGRAM, "c")
+        self.assertFalse(scheduler.is_full(PRIORITY_INTERCOM))
+        intercom = await self.wait_for(scheduler, PRIORITY_INTERCOM, "d")
+
+        with self.assertRaises(SchedulerBusy):
+            await newer
+        self.assertFalse(older.done())
+        self.assertEqual(scheduler.waiting, 2)
+        # The displacing query is served first, ahead of the older lower priority one
+        scheduler.release()
+        await intercom
+        self.assertFalse(older.done())
+
+    async def test_limits_queries_waiting_per_sender(self):
+        scheduler = QueryScheduler(max_concurrency=1, max_queue=10, max_queue_per_sender=1)
+        await scheduler.acquire(PRIORITY_TELEGRAM, "a")
+        await self.wait_for(scheduler, PRIORITY_TELEGRAM, "b")
+        with self.assertRaises(SchedulerBusy):
+            await scheduler.acquire(PRIORITY_TELEGRAM, "b")
+        await self.wait_for(scheduler, PRIORITY_TELEGRAM, "c")
+        self.assertEqual(scheduler.waiting, 2)
+
+    async def test_serves_senders_round_robin(self):
+        scheduler = QueryScheduler(max_concurrency=1, max_queue=10)
+        await scheduler.acquire(PRIORITY_TELEGRAM, "holder")
+        served = []
+
+        async def query(sender):
+            await scheduler.acquire(PRIORITY_TELEGRAM, sender)
+            served.append(sender)
+
+        tasks = []
+        for sender in ["a", "a", "a", "b", "c"]:
+            tasks.append(asyncio.create_task(query(sender)))
+            await asyncio.sleep(0)
+        for _ in tasks:
+            scheduler.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        self.assertEqual(served, ["a", "b", "c", "a", "a"])
+
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        scheduler = QueryScheduler(max_concurrency=1, max_queue=1)
+        await scheduler.acquire(PRIORITY_TELEGRAM, "a")
+        waiter = await self.wait_for(scheduler, PRIORITY_TELEGRAM, "b")
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertEqual(scheduler.waiting, 0)
+        self.assertFalse(scheduler.is_full(PRIORITY_TELEGRAM))
+        scheduler.release()
+        self.assertEqual(scheduler.running, 0)
+
+    async def test_slot_handed_to_a_cancelled_waiter_passes_to_the_next(self):
+        scheduler = QueryScheduler(max_concurrency=1, max_queue=2)
+        await scheduler.acquire(PRIORITY_TELEGRAM, "a")
+        first = await self.wait_for(scheduler, PRIORITY_TELEGRAM, "b")
+        second = await self.wait_for(scheduler, PRIORITY_TELEGRAM, "c")
+        # The slot goes to the first waiter, which is cancelled before it gets to run
+        scheduler.release()
+        first.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+        await second
+        self.assertEqual(scheduler.running, 1)
+        self.assertEqual(scheduler.waiting, 0)
+
+    async def test_slot_context_releases_on_error(self):
+        scheduler = QueryScheduler(max_concurrency=1, max_queue=1)
+        with self.assertRaises(ValueError):
+            async with scheduler.slot(PRIORITY_TELEGRAM, "a"):
+                raise ValueError("boom")
+        self.assertEqual(scheduler.running, 0)
+
+if __name__ == '__main__':
+    unittest.main()
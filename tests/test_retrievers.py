@@ -0,0 +1,55 @@
+# test_retrievers.py
+"""Tests the context token budget and rank fusion in retrievers.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+from langchain_core.documents import Document
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from retrievers import fit_to_budget, reciprocal_rank_fusion
+
+def make_doc(article_id, words, token_count=None):
+    metadata = {"article_id": article_id, "chunk_index": 0}
+    if token_count is not None:
+        metadata["token_count"] = token_count
+    return Document(page_content=" ".join(f"w{i}" for i in range(words)), metadata=metadata)
+
+def ids(documents):
+    return [doc.metadata["article_id"] for doc in documents]
+
+class FitToBudgetTest(unittest.TestCase):
+    def test_keeps_everything_within_the_budget(self):
+        documents = [make_doc("1", 10), make_doc("2", 10)]
+        self.assertEqual(fit_to_budget(documents, 20), documents)
+
+    def test_trims_the_document_that_crosses_the_budget(self):
+        selected = fit_to_budget([make_doc("1", 10), make_doc("2", 50), make_doc("3", 5)], 45, min_trim_tokens=8)
+        self.assertEqual(ids(selected), ["1", "2"])
+        self.assertEqual(selected[1].page_content, " ".join(f"w{i}" for i in range(35)))
+        self.assertEqual(selected[1].metadata["token_count"], 35)
+
+    def test_drops_a_document_when_too_little_budget_is_left_to_trim(self):
+        selected = fit_to_budget([make_doc("1", 40), make_doc("2", 50), make_doc("3", 5)], 45, min_trim_tokens=8)
+        self.assertEqual(ids(selected), ["1", "3"])
+
+    def test_uses_the_stored_token_count(self):
+        selected = fit_to_budget([make_doc("1", 5, token_count=100), make_doc("2", 5)], 50, min_trim_tokens=60)
+        self.assertEqual(ids(selected), ["2"])
+
+    def test_zero_budget(self):
+        self.assertEqual(fit_to_budget([make_doc("1", 5)], 0), [])
+
+class ReciprocalRankFusionTest(unittest.TestCase):
+    def test_documents_in_both_rankings_come_first(self):
+        vector = [make_doc("1", 1), make_doc("2", 1), make_doc("3", 1)]
+        lexical = [make_doc("3", 1), make_doc("4", 1)]
+        self.assertEqual(ids(reciprocal_rank_fusion([vector, lexical], k=2)), ["3", "1"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# test_supplemental_store.py
+"""Tests replaying the SupplementalStore log and importing the legacy JSON file.
+
+    python -m unittest discover tests
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import supplemental_store
+from supplemental_store import ID_PREFIX, SupplementalStore, entry_id
+
+class SupplementalStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.legacy_path = os.path.join(self.directory.name, "supplemental_info.json")
+        self.patch = mock.patch.object(supplemental_store, 'LEGACY_SUPPLEMENTAL_PATH', self.legacy_path)
+        self.patch.start()
+        self.store = SupplementalStore(os.path.join(self.directory.name, "supplemental_info.jsonl"))
+
+    def tearDown(self):
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def test_empty_without_a_log(self):
+        self.assertEqual(self.store.load(), {})
+
+    def test_ids_are_prefixed_and_stable(self):
+        self.assertTrue(entry_id("How do I export?").startswith(ID_PREFIX))
+        self.assertEqual(entry_id("How do I export?"), entry_id("how do i   EXPORT?"))
+
+    def test_last_write_wins(self):
+        first = self.store.put("How do I export?", "Old answer.")
+        self.store.put("How do I export?", "New answer.")
+        entries = self.store.load()
+        self.assertEqual(list(entries), [first["id"]])
+        self.assertEqual(entries[first["id"]]["answer"], "New answer.")
+
+    def test_edit_by_id_keeps_the_id(self):
+        entry = self.store.put("How do I export?", "Answer.")
+        self.store.put("How can I export contacts?", "Answer.", supplemental_id=entry["id"])
+        self.assertEqual(self.store.load()[entry["id"]]["question"], "How can I export contacts?")
+
+    def test_delete(self):
+        kept = self.store.put("How do I export?", "Answer.")
+        deleted = self.store.put("How do I import?", "Answer.")
+        self.store.delete(deleted["id"])
+        self.store.delete("supplemental_missing")
+        self.assertEqual(list(self.store.load()), [kept["id"]])
+
+    def test_skips_a_truncated_line(self):
+        entry = self.store.put("How do I export?", "Answer.")
+        with open(self.store.path, 'a', encoding='utf-8') as f:
+            f.write('{"op": "put", "id": "supplemental_cut')
+        self.assertEqual(list(self.store.load()), [entry["id"]])
+
+    def test_imports_the_legacy_file_once(self):
+        with open(self.legacy_path, 'w') as f:
+            json.dump([{"question": "How do I export?", "answer": "Answer."}], f)
+        self.assertEqual([entry["question"] for entry in self.store.load().values()], ["How do I export?"])
+        with open(self.legacy_path, 'w') as f:
+            json.dump([{"question": "How do I import?", "answer": "Answer."}], f)
+        self.assertEqual(len(self.store.load()), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,17 @@
 # utils.py
-def strip_html(content):
-    """Strips HTML tags from content using BeautifulSoup."""
-    from bs4 import BeautifulSoup
-    soup = BeautifulSoup(content, "html.parser")
-    return soup.get_text()
+import re
+
+def count_tokens(text):
+    """Approximates the number of model tokens in text by counting words and punctuation."""
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+def parse_duration(value):
+    """Converts an Ollama-style duration ("300", "45s", "30m", "1h30m") to seconds."""
+    value = str(value).strip()
+    if re.fullmatch(r"-?\d+(\.\d+)?", value):
+        return float(value)
+    parts = re.findall(r"(-?\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts or "".join(number + unit for number, unit in parts) != value:
+        raise ValueError(f"Invalid duration: {value}")
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
@@ -0,0 +1,296 @@
+# load_test.py
+"""End-to-end load test of the query path against local stand-ins for Ollama and GPT4All.
+
+Builds a throwaway index from a synthetic (or given) article set with a deterministic
+hashing embedder, going through the real ingest pipeline against a fake Intercom API. The
+same local server stands in for Ollama and streams tokens at a configurable rate. It then replays a question set through the real Telegram handler (telegram_bot.answer_query)
+and/or the real Quart /intercom route at a fixed concurrency. Reports p50/p95/p99 latency,
+time to first token and throughput, and can save results to compare run over run.
+Bot settings such as QUERY_CONCURRENCY or RETRIEVER_MODE are read from the environment as usual.
+
+    python utils/load_test.py --questions questions.csv --concurrency 8 --path both --output run.json
+    python utils/load_test.py --concurrency 8 --compare run.json
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--questions', default='questions.csv', help="CSV with a 'question' column")
+    parser.add_argument('--articles', help="JSON list of Intercom articles to index instead of a synthetic corpus")
+    parser.add_argument('--corpus-size', type=int, default=500, help="synthetic articles to index")
+    parser.add_argument('--requests', type=int, help="queries to send per path (defaults to one per question)")
+    parser.add_argument('--concurrency', type=int, default=4, help="queries in flight at once")
+    parser.add_argument('--path', choices=['telegram', 'http', 'both'], default='both')
+    parser.add_argument('--token-rate', type=float, default=40.0, help="fake Ollama tokens per second")
+    parser.add_argument('--answer-tokens', type=int, default=60, help="tokens in each fake answer")
+    parser.add_argument('--latency', type=float, default=0.05, help="fake Ollama fixed seconds before prefill")
+    parser.add_argument('--prefill-rate', type=float, default=2000.0, help="fake Ollama prompt tokens per second")
+    parser.add_argument('--answer-cache', action='store_true', help="leave the semantic answer cache on")
+    parser.add_argument('--output', help="write results as JSON here")
+    parser.add_argument('--compare', help="print deltas against a previous --output file")
+    return parser.parse_args()
+
+class FakeEmbedder:
+    """Deterministic bag-of-words hashing embedder with the interface vector_store expects."""
+
+    def __init__(self, dimensions=384):
+        self.dimensions = dimensions
+
+    def embed_query(self, text):
+        vector = [0.0] * self.dimensions
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(word.encode('utf-8')).digest()
+            vector[int.from_bytes(digest[:4], 'little') % self.dimensions] += 1.0 if digest[4] & 1 else -1.0
+        norm = sum(value * value for value in vector) ** 0.5 or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    embed_uncached = embed_documents
+
+    def __call__(self, input):
+        return self.embed_documents(input)
+
+def start_fake_server(args, articles):
+    """Serves Ollama's /api/generate and Intercom's /articles on a random local port from a
+    background thread. Returns its base URL."""
+    from aiohttp import web
+
+    async def list_articles(request):
+        page = int(request.query.get('page', 1))
+        per_page = int(request.query.get('per_page', 50))
+        ordered = sorted(articles, key=lambda article: article.get('updated_at') or 0, reverse=True)
+        total_pages = max(1, -(-len(ordered) // per_page))
+        return web.json_response({"data": ordered[(page - 1) * per_page:page * per_page],
+                                  "pages": {"page": page, "total_pages": total_pages}})
+
+    async def generate(request):
+        payload = await request.json()
+        prompt_tokens = len(re.findall(r"\w+|[^\w\s]", payload.get('prompt', '')))
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        await asyncio.sleep(args.latency + prompt_tokens / args.prefill_rate)
+        for i in range(args.answer_tokens):
+            chunk = {"model": payload.get('model'), "response": f"token{i} ", "done": False}
+            await response.write((json.dumps(chunk) + "\n").encode('utf-8'))
+            await asyncio.sleep(1 / args.token_rate)
+        final = {"model": payload.get('model'), "response": "", "done": True,
+                 "prompt_eval_count": prompt_tokens, "eval_count": args.answer_tokens}
+        await response.write((json.dumps(final) + "\n").encode('utf-8'))
+        await response.write_eof()
+        return response
+
+    ready = threading.Event()
+    address = {}
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post('/api/generate', generate)
+        app.router.add_get('/articles', list_articles)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        loop.run_until_complete(site.start())
+        address['port'] = site._server.sockets[0].getsockname()[1]
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True, name='fake-server').start()
+    ready.wait()
+    return f"http://127.0.0.1:{address['port']}"
+
+def load_questions(path, articles):
+    if os.path.exists(path):
+        with open(path, newline='') as f:
+            reader = csv.DictReader(f)
+            if 'question' not in (reader.fieldnames or []):
+                raise KeyError(f"'question' column not found in CSV. Available columns: {reader.fieldnames}")
+            return [row['question'] for row in reader if row['question'].strip()]
+    logging.warning(f"{path} not found, asking about the titles of the indexed articles instead")
+    return [f"How do I {article['title'].lower()}?" for article in articles[:200]]
+
+def synthetic_articles(count):
+    topics = ["billing", "refunds", "login", "password reset", "api keys", "webhooks", "exports", "invoices",
+              "team members", "permissions", "notifications", "integrations", "data retention", "sso", "mobile app"]
+    actions = ["set up", "troubleshoot", "change", "remove", "configure", "understand"]
+    articles = []
+    for i in range(count):
+        topic = topics[i % len(topics)]
+        action = actions[(i // len(topics)) % len(actions)]
+        paragraphs = "".join(
+            f"<p>Step {step}: to {action} {topic}, open Settings and choose {topic.title()} (ref ERR-{1000 + i}).</p>"
+            for step in range(1, 6)
+        )
+        articles.append({"id": str(i), "title": f"{action} {topic} {i}", "body": f"<h2>{topic}</h2>{paragraphs}",
+                         "author_id": 1, "created_at": 1, "updated_at": 1, "state": "published"})
+    return articles
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+def summarize(samples, elapsed):
+    served = [sample for sample in samples if sample["outcome"] in ("answered", "cached", "coalesced")]
+    latencies = [sample["latency"] for sample in served]
+    first_tokens = [sample["ttft"] for sample in served]
+    outcomes = {}
+    for sample in samples:
+        outcomes[sample["outcome"]] = outcomes.get(sample["outcome"], 0) + 1
+    return {
+        "requests": len(samples),
+        "outcomes": outcomes,
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "ttft_p50": percentile(first_tokens, 0.50),
+        "ttft_p95": percentile(first_tokens, 0.95),
+        "ttft_p99": percentile(first_tokens, 0.99),
+    }
+
+class FakeMessage:
+    async def edit(self, text, **kwargs):
+        self.text = text
+
+class FakeEvent:
+    """Just enough of a Telethon NewMessage event for telegram_bot.answer_query."""
+
+    def __init__(self, question, chat_id):
+        self.pattern_match = re.match(r'^\.x (.+)', f".x {question}", re.DOTALL)
+        self.chat_id = chat_id
+
+    async def respond(self, text, **kwargs):
+        return FakeMessage()
+
+async def run_path(path, questions, count, concurrency):
+    import telegram_bot
+    import web_server
+
+    client = web_server.app.test_client()
+    queue = asyncio.Queue()
+    for i in range(count):
+        queue.put_nowait(questions[i % len(questions)])
+    samples = []
+
+    async def send(worker, question):
+        started = time.time()
+        if path == "telegram":
+            result = await telegram_bot.answer_query(FakeEvent(question, chat_id=worker))
+            busy = result.get("busy")
+        else:
+            response = await client.post('/intercom', json={"body": question, "conversation_id": f"load-{worker}"})
+            busy = response.status_code == 503
+            result = await response.get_json() if response.status_code in (200, 503) else {"error": True}
+        latency = time.time() - started
+        if busy:
+            outcome = "busy"
+        elif "response" not in result or result["response"] == "An error occurred while processing the query.":
+            outcome = "error"
+        elif result.get("coalesced"):
+            outcome = "coalesced"
+        else:
+            outcome = "cached" if result.get("cached") else "answered"
+        return {"latency": latency, "ttft": result.get("time_to_first_token", latency), "outcome": outcome}
+
+    async def worker(index):
+        while not queue.empty():
+            question = queue.get_nowait()
+            samples.append(await send(index, question))
+
+    started = time.time()
+    await asyncio.gather(*(worker(index) for index in range(concurrency)))
+    return summarize(samples, time.time() - started)
+
+def print_summary(path, summary, previous=None):
+    print(f"\n== {path} ==")
+    print(f"requests: {summary['requests']}  outcomes: {summary['outcomes']}  elapsed: {summary['elapsed']:.2f}s")
+    for key in ("throughput", "latency_p50", "latency_p95", "latency_p99", "ttft_p50", "ttft_p95", "ttft_p99"):
+        line = f"{key:>12}: {summary[key]:8.3f}"
+        if previous and key in previous:
+            before = previous[key]
+            change = (summary[key] - before) / before * 100 if before else 0.0
+            line += f"   (was {before:8.3f}, {change:+.1f}%)"
+        print(line)
+
+async def main(args):
+    # Everything the bot persists goes to a scratch directory so real indexes and caches are untouched
+    scratch = tempfile.mkdtemp(prefix='load_test_')
+    os.environ['CHROMA_PERSIST_DIR'] = os.path.join(scratch, 'chroma_db')
+    os.environ['EMBEDDING_CACHE_PATH'] = os.path.join(scratch, 'embedding_cache.sqlite3')
+    os.environ['EMBED_WORKERS'] = '1'
+    os.environ['SUPPLEMENTAL_STORE_PATH'] = os.path.join(scratch, 'supplemental_info.jsonl')
+    os.environ['SYNC_STATE_PATH'] = os.path.join(scratch, 'sync_state.json')
+    if args.articles:
+        with open(args.articles, 'r') as f:
+            articles = json.load(f)
+    else:
+        articles = synthetic_articles(args.corpus_size)
+    fake_server_url = start_fake_server(args, articles)
+    os.environ['OLLAMA_BASE_URL'] = fake_server_url
+    os.environ['INTERCOM_API_URL'] = fake_server_url
+    if not args.answer_cache:
+        os.environ['ANSWER_CACHE_SIZE'] = '0'
+    sys.path.insert(0, REPO_ROOT)
+
+    import ingest
+    import metrics
+    import telegram_bot
+    import vector_store
+
+    vector_store.set_embedder(FakeEmbedder())
+    vector_store.llm.callbacks = None  # Don't echo every fake token to stdout
+
+    template = "Answer the question based on the provided context.\n\nContext:\n{context}\n\nQuestion:\n{question}\n\nAnswer:"
+    started = time.time()
+    qa_chain = await ingest.stream_rebuild_vectorstore('load-test', template)
+    print(f"Indexed {len(articles)} articles in {time.time() - started:.2f}s")
+    telegram_bot.set_qa_chain(qa_chain)
+
+    questions = load_questions(args.questions, articles)
+    count = args.requests or len(questions)
+    paths = ["telegram", "http"] if args.path == "both" else [args.path]
+
+    previous = {}
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            previous = json.load(f).get("results", {})
+
+    results = {}
+    for path in paths:
+        results[path] = await run_path(path, questions, count, args.concurrency)
+        print_summary(path, results[path], previous.get(path))
+
+    stages = metrics.parse(metrics.render())
+    print("\n== stage averages (s) ==")
+    for name in ("chatbot_query_embedding_seconds", "chatbot_query_queue_wait_seconds", "chatbot_retrieval_seconds",
+                 "chatbot_llm_time_to_first_token_seconds", "chatbot_llm_generation_seconds"):
+        observed = stages.get(f"{name}_count", 0)
+        print(f"{name}: {stages.get(f'{name}_sum', 0) / observed if observed else 0.0:.4f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(message)s')
+    asyncio.run(main(parse_args()))
@@ -1,9 +1,13 @@
 # vector_store.py
+import asyncio
+import hashlib
 import json
 import logging
+import multiprocessing
 import os  # Ensure this import is present
-import time  # Add this import statement
-from bs4 import BeautifulSoup
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from langchain_community.vectorstores import Chroma
 from langchain_community.embeddings import GPT4AllEmbeddings
 from langchain.chains import RetrievalQA
@@ -14,6 +18,79 @@ from langchain_community.llms import Ollama
 from langchain.callbacks.manager import CallbackManager
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from langchain_community.vectorstores.utils import filter_complex_metadata
+from bm25_index import BM25Index
+from embedding_cache import EmbeddingCache
+from flat_index import FlatIndex
+from html_text import strip_html
+import metrics
+from retrievers import FlatRetriever, HybridRetriever, TokenBudgetRetriever
+from supplemental_store import SupplementalStore
+from utils import count_tokens, parse_duration
+
+COLLECTION_NAME = "intercom_articles"
+EMBEDDING_MODEL = "all-MiniLM-L6-v2.gguf"
+# Bump whenever the document/metadata layout changes so persisted indexes get rebuilt
+INDEX_SCHEMA_VERSION = 5
+PERSIST_DIRECTORY = os.getenv('CHROMA_PERSIST_DIR', 'chroma_db')
+INDEX_STAMP_FILE = os.path.join(PERSIST_DIRECTORY, 'index_stamp.json')
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', 'logs/embedding_cache.sqlite3')
+EMBEDDING_CACHE_MAX_MB = int(os.getenv('EMBEDDING_CACHE_MAX_MB', '256'))
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', '64'))
+# Embedding models used during rebuilds, counting this process's own. Each one gets an equal share
+# of the cores as threads, so adding workers never oversubscribes the CPU.
+EMBED_WORKERS = max(1, int(os.getenv('EMBED_WORKERS', str(min(4, max(1, (os.cpu_count() or 1) // 2))))))
+EMBED_THREADS = max(1, (os.cpu_count() or 1) // EMBED_WORKERS)
+# Seconds the embedding pool is kept after a rebuild before its processes are shut down
+EMBED_POOL_IDLE_SECONDS = float(os.getenv('EMBED_POOL_IDLE_SECONDS', '300'))
+CHUNK_MAX_TOKENS = int(os.getenv('CHUNK_MAX_TOKENS', '256'))
+CHUNK_OVERLAP_TOKENS = int(os.getenv('CHUNK_OVERLAP_TOKENS', '32'))
+# "hybrid" fuses vector and BM25 rankings, "vector" uses similarity search alone
+RETRIEVER_MODE = os.getenv('RETRIEVER_MODE', 'hybrid')
+RETRIEVAL_K = int(os.getenv('RETRIEVAL_K', '4'))
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', '20'))
+RRF_K = int(os.getenv('RRF_K', '60'))
+# Most tokens of retrieved context put into a prompt; 0 disables the limit
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '1024'))
+OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
+OLLAMA_MODEL = "custom-chat-bot"
+# How long Ollama keeps the model loaded after a request: a duration like "30m", or seconds ("-1" keeps it forever)
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+# Ollama takes plain numbers as seconds but strings only with a unit
+if OLLAMA_KEEP_ALIVE.lstrip('-').isdigit():
+    OLLAMA_KEEP_ALIVE = int(OLLAMA_KEEP_ALIVE)
+# Parsed here so a malformed value stops startup instead of surfacing later; zero or negative
+# means there is nothing to keep warm
+OLLAMA_KEEP_ALIVE_SECONDS = parse_duration(OLLAMA_KEEP_ALIVE)
+# Model options left unset fall back to the Modelfile / Ollama defaults
+OLLAMA_OPTIONS = {
+    name: int(os.getenv(variable))
+    for name, variable in (("num_ctx", 'OLLAMA_NUM_CTX'), ("num_thread", 'OLLAMA_NUM_THREAD'))
+    if os.getenv(variable)
+}
+# HTTP worker processes for /intercom; above 1 they run under hypercorn next to the main process (see http_worker.py)
+HTTP_WORKERS = int(os.getenv('HTTP_WORKERS', '1'))
+# "chroma" searches the collection itself, "flat" an exact NumPy snapshot of it. With more than one
+# HTTP worker it has to be "flat", since the workers serve from the snapshot the main process keeps current.
+RETRIEVER_BACKEND = os.getenv('RETRIEVER_BACKEND', 'flat' if HTTP_WORKERS > 1 else 'chroma')
+if HTTP_WORKERS > 1 and RETRIEVER_BACKEND != 'flat':
+    raise ValueError(f"HTTP_WORKERS={HTTP_WORKERS} needs RETRIEVER_BACKEND=flat, not {RETRIEVER_BACKEND}: "
+                     f"the workers serve from the flat index snapshot")
+FLAT_INDEX_PATH = os.getenv('FLAT_INDEX_PATH', os.path.join(PERSIST_DIRECTORY, 'flat_index.npy'))
+
+vectorstore = None
+embedder = None
+embedding_cache = None
+worker_embedder = None  # Model owned by an embedding pool worker process
+embedding_executor = None
+embedding_executor_timer = None  # Pending idle shutdown of embedding_executor
+bm25_index = None  # Keyword index over the same chunks as vectorstore, built on first use
+flat_index = None
+flat_index_version = None  # index_version the flat index snapshot was taken at
+flat_index_lock = threading.Lock()  # Queries and live upserts can both ask for a fresh snapshot
+# GPT4All models are not thread-safe, and queries, retrievers and rebuilds all embed from different threads
+embedder_lock = threading.Lock()
+# Bumped every time the indexed content changes so answers cached against older content are dropped
+index_version = 0
 
 def metadata_func(record: dict, metadata: dict) -> dict:
     metadata["title"] = record.get("title")
@@ -22,118 +99,574 @@ def metadata_func(record: dict, metadata: dict) -> dict:
     metadata["id"] = record.get("id")
     return metadata
 
-def strip_html(content):
-    """Strips HTML tags from content using BeautifulSoup."""
-    soup = BeautifulSoup(content, "html.parser")
-    return soup.get_text()
+def is_heading(block):
+    """Guesses whether a line of stripped text is a section heading."""
+    return count_tokens(block) <= 12 and not block.rstrip().endswith(('.', '!', '?', ':', ','))
+
+def split_words(block, max_tokens):
+    """Splits a block that is too long on its own into runs of at most max_tokens."""
+    pieces = []
+    current = []
+    current_tokens = 0
+    for word in block.split():
+        word_tokens = count_tokens(word)
+        if current and current_tokens + word_tokens > max_tokens:
+            pieces.append(" ".join(current))
+            current, current_tokens = [], 0
+        current.append(word)
+        current_tokens += word_tokens
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+def overlap_tail(text, overlap_tokens):
+    """Returns the trailing words of text that add up to about overlap_tokens."""
+    words = text.split()
+    tail = []
+    tail_tokens = 0
+    while words and tail_tokens < overlap_tokens:
+        word = words.pop()
+        tail.insert(0, word)
+        tail_tokens += count_tokens(word)
+    return " ".join(tail)
+
+def chunk_text(text, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """Splits stripped article text on headings and paragraphs into chunks of at most max_tokens.
+
+    Each chunk after the first starts with roughly overlap_tokens from the end of the previous
+    one, except where a new section starts at a heading.
+    """
+    pieces = []
+    for block in (line.strip() for line in text.splitlines()):
+        if not block:
+            continue
+        if count_tokens(block) <= max_tokens:
+            pieces.append(block)
+        else:
+            pieces.extend(split_words(block, max(1, max_tokens - overlap_tokens)))
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for piece in pieces:
+        piece_tokens = count_tokens(piece)
+        new_section = is_heading(piece) and current_tokens >= max_tokens // 2
+        if current and (new_section or current_tokens + piece_tokens > max_tokens):
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+            tail = "" if new_section or not overlap_tokens else overlap_tail(chunks[-1], overlap_tokens)
+            if tail and count_tokens(tail) + piece_tokens <= max_tokens:
+                current, current_tokens = [tail], count_tokens(tail)
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def clean_value(v):
+    """Coerce a single metadata value to a string, int, float, or bool."""
+    if isinstance(v, (str, int, float, bool)):
+        return v
+    elif isinstance(v, list):
+        return ', '.join(map(str, v))  # Convert list to a comma-separated string
+    elif v is None:
+        return ''  # Replace None with empty string
+    return str(v)  # Convert other types to string
 
 def clean_metadata(metadata):
     """Ensure metadata values are strings, ints, floats, or bools."""
-    cleaned_metadata = {}
-    for k, v in metadata.items():
-        if isinstance(v, (str, int, float, bool)):
-            cleaned_metadata[k] = v
-        elif isinstance(v, list):
-            cleaned_metadata[k] = ', '.join(map(str, v))  # Convert list to a comma-separated string
-        elif v is None:
-            cleaned_metadata[k] = ''  # Replace None with empty string
-        else:
-            cleaned_metadata[k] = str(v)  # Convert other types to string
-    return cleaned_metadata
+    return {k: clean_value(v) for k, v in metadata.items()}
+
+def content_hash(record):
+    """Hashes the parts of a record that end up in its indexed document."""
+    payload = f"{record.get('title') or ''}\n{record.get('body') or ''}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get_embedding_cache():
+    global embedding_cache
+    if embedding_cache is None:
+        embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_MB * 1024 * 1024)
+    return embedding_cache
 
 class CustomGPT4AllEmbeddings(GPT4AllEmbeddings):
     def __call__(self, input):
         return self.embed_documents(input)
 
-llm = Ollama(model="custom-chat-bot", callback_manager=CallbackManager([StreamingStdOutCallbackHandler()]))
+    def embed_documents(self, texts):
+        """Embeds texts, only running the model on the ones missing from the embedding cache."""
+        cache = get_embedding_cache()
+        embeddings = cache.get_many(EMBEDDING_MODEL, texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            computed = self.embed_uncached([texts[i] for i in missing])
+            cache.put_many(EMBEDDING_MODEL, [texts[i] for i in missing], computed)
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+        return embeddings
+
+    def embed_uncached(self, texts):
+        with embedder_lock:
+            return super().embed_documents(texts)
+
+def init_embed_worker():
+    global worker_embedder
+    worker_embedder = CustomGPT4AllEmbeddings(model=EMBEDDING_MODEL, n_threads=EMBED_THREADS)
+
+def embed_batch(texts):
+    return worker_embedder.embed_uncached(texts)
+
+def get_embedding_executor():
+    """Returns the pool of EMBED_WORKERS - 1 model processes, or None if EMBED_WORKERS is 1.
+
+    This process's own model is the remaining worker, so there is never a model loaded twice
+    in the same process. The pool starts on first use and stays up until it has been idle
+    for EMBED_POOL_IDLE_SECONDS after release_embedding_executor, so back-to-back rebuilds
+    only pay for loading the models once.
+    """
+    global embedding_executor, embedding_executor_timer
+    if embedding_executor_timer is not None:
+        embedding_executor_timer.cancel()
+        embedding_executor_timer = None
+    if embedding_executor is None and EMBED_WORKERS > 1:
+        embedding_executor = ProcessPoolExecutor(max_workers=EMBED_WORKERS - 1,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=init_embed_worker)
+    return embedding_executor
+
+def release_embedding_executor():
+    """Schedules the embedding pool to shut down after EMBED_POOL_IDLE_SECONDS unless it is used again.
+
+    Call from the event loop once a rebuild is done with the pool.
+    """
+    global embedding_executor_timer
+    if embedding_executor is None:
+        return
+    if embedding_executor_timer is not None:
+        embedding_executor_timer.cancel()
+    embedding_executor_timer = asyncio.get_running_loop().call_later(
+        EMBED_POOL_IDLE_SECONDS, shutdown_embedding_executor)
+
+def shutdown_embedding_executor():
+    """Stops the embedding pool's processes, freeing their models; the next rebuild starts a new one."""
+    global embedding_executor, embedding_executor_timer
+    if embedding_executor_timer is not None:
+        embedding_executor_timer.cancel()
+        embedding_executor_timer = None
+    if embedding_executor is not None:
+        logging.info("Shutting down the idle embedding pool.")
+        embedding_executor.shutdown(wait=False)
+        embedding_executor = None
+
+async def embed_texts(texts, executor=None):
+    """Embeds texts in EMBED_BATCH_SIZE batches, with cached vectors reused.
+
+    Batches go to executor (the pool from get_embedding_executor) if given, otherwise to this
+    process's model one after another on a thread. Output order matches texts, and all model
+    work happens off the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    cache = get_embedding_cache()
+    embeddings = await loop.run_in_executor(None, cache.get_many, EMBEDDING_MODEL, texts)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if not missing:
+        return embeddings
+
+    batches = [missing[start:start + EMBED_BATCH_SIZE] for start in range(0, len(missing), EMBED_BATCH_SIZE)]
+    embed = embed_batch if executor is not None else get_embedder().embed_uncached
+    if len(batches) > 1:
+        logging.info(f"Embedding {len(missing)} texts in {len(batches)} batches...")
+
+    async def run_batch(batch):
+        return batch, await loop.run_in_executor(executor, embed, [texts[i] for i in batch])
+
+    if executor is None:
+        # There is only the one in-process model, so hand it the batches in turn instead of
+        # queueing them all on the thread pool at once
+        batch_results = (run_batch(batch) for batch in batches)
+        pending = []
+    else:
+        pending = [asyncio.ensure_future(run_batch(batch)) for batch in batches]
+        batch_results = asyncio.as_completed(pending)
+    try:
+        done = 0
+        for finished in batch_results:
+            batch, computed = await finished
+            for i, embedding in zip(batch, computed):
+                embeddings[i] = embedding
+            done += len(batch)
+            if len(batches) > 1:
+                logging.info(f"Embedded {done}/{len(missing)} texts")
+    finally:
+        # The pool outlives this call, so drop any batches still queued on it after a failure
+        for task in pending:
+            task.cancel()
+
+    await loop.run_in_executor(None, cache.put_many, EMBEDDING_MODEL,
+                               [texts[i] for i in missing], [embeddings[i] for i in missing])
+    return embeddings
+
+def get_embedder():
+    global embedder
+    if embedder is None:
+        embedder = CustomGPT4AllEmbeddings(model=EMBEDDING_MODEL, n_threads=EMBED_THREADS)
+    return embedder
+
+def set_embedder(embedder_instance):
+    """Replaces the in-process embedder, e.g. with a deterministic stand-in for load tests.
+
+    It needs embed_documents, embed_query and embed_uncached. Keep EMBED_WORKERS at 1 so
+    rebuilds use it instead of spawning model workers.
+    """
+    global embedder
+    embedder = embedder_instance
+
+metrics.INDEX_CHUNKS.set_function(lambda: vectorstore._collection.count() if vectorstore is not None else 0)
+metrics.EMBEDDING_CACHE_HIT_RATIO.set_function(
+    lambda: embedding_cache.stats()["hit_rate"] if embedding_cache is not None else 0.0
+)
+
+llm = Ollama(model=OLLAMA_MODEL, base_url=OLLAMA_BASE_URL, keep_alive=OLLAMA_KEEP_ALIVE, **OLLAMA_OPTIONS,
+             callback_manager=CallbackManager([StreamingStdOutCallbackHandler()]))
+
+def current_index_stamp():
+    return {"schema_version": INDEX_SCHEMA_VERSION, "embedding_model": EMBEDDING_MODEL}
+
+def read_index_stamp():
+    if not os.path.exists(INDEX_STAMP_FILE):
+        return None
+    try:
+        with open(INDEX_STAMP_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read index stamp {INDEX_STAMP_FILE}: {str(e)}")
+        return None
+
+def write_index_stamp():
+    os.makedirs(PERSIST_DIRECTORY, exist_ok=True)
+    with open(INDEX_STAMP_FILE, 'w') as f:
+        json.dump(current_index_stamp(), f)
+
+def persisted_collection():
+    return Chroma(collection_name=COLLECTION_NAME, embedding_function=get_embedder(),
+                  persist_directory=PERSIST_DIRECTORY)
+
+def open_vectorstore():
+    """Opens the persisted collection, wiping it first if its stamp is stale."""
+    store = persisted_collection()
+    stamp = read_index_stamp()
+    if stamp != current_index_stamp():
+        logging.info(f"Index stamp {stamp} does not match {current_index_stamp()}, doing a full rebuild.")
+        store.delete_collection()
+        store = persisted_collection()
+    return store
+
+def load_vectorstore(prompt_template):
+    """Returns a QA chain over the persisted index, or None if it is missing, empty or stale."""
+    global vectorstore, bm25_index
+    if read_index_stamp() != current_index_stamp():
+        return None
+    try:
+        store = open_vectorstore()
+        count = store._collection.count()
+    except Exception as e:
+        logging.error(f"Error opening persisted vector store: {str(e)}", exc_info=True)
+        return None
+    if not count:
+        return None
+
+    vectorstore = store
+    bm25_index = None
+    logging.info(f"Loaded persisted vector store with {count} documents.")
+    return build_qa_chain(vectorstore, prompt_template)
+
+def supplemental_record(entry):
+    """Converts a supplemental store entry into an article-shaped record."""
+    return {
+        "id": entry["id"],
+        "type": "article",
+        "workspace_id": "supplemental",
+        "parent_id": None,
+        "parent_type": None,
+        "parent_ids": [],
+        "title": entry["question"],
+        "description": entry["question"],
+        "body": entry["answer"],
+        "author_id": None,
+        "state": "published",
+        "created_at": entry["updated_at"],
+        "updated_at": entry["updated_at"],
+        "url": None
+    }
+
+def load_supplemental_records():
+    """Converts the supplemental Q&A store, if present, into article-shaped records."""
+    entries = SupplementalStore().load()
+    if entries:
+        logging.info(f"Total records received from supplemental: {len(entries)}")
+    return [supplemental_record(entry) for entry in entries.values()]
+
+def chunk_id(metadata):
+    return f"{metadata['article_id']}:{metadata['chunk_index']}"
+
+def build_documents(record, stripped_content=None):
+    """Turns a record into one Document per chunk, or an empty list if it has no usable body.
+
+    Pass stripped_content when the body has already been converted to text.
+    """
+    if not (record.get("body") and record["body"].strip()):
+        return []
+    if stripped_content is None:
+        stripped_content = strip_html(record["body"])
+    if not stripped_content.strip():
+        return []
+
+    # The chunk text replaces the raw body, so don't copy it into every chunk's metadata
+    base_metadata = clean_metadata({k: v for k, v in record.items() if k != "body"})
+    base_metadata["article_id"] = str(record.get("id"))
+    base_metadata["content_hash"] = content_hash(record)
+
+    chunks = chunk_text(stripped_content)
+    documents = []
+    for index, chunk in enumerate(chunks):
+        # token_count lets the context budget be applied at query time without re-counting
+        metadata = dict(base_metadata, chunk_index=index, chunk_count=len(chunks), token_count=count_tokens(chunk))
+        documents.append(Document(page_content=chunk, metadata=metadata))
+    return documents
+
+def get_indexed_state(store):
+    """Returns {article id: {"updated_at", "content_hash", "chunk_ids"}} for everything indexed."""
+    existing = store.get(include=["metadatas"])
+    state = {}
+    for doc_id, metadata in zip(existing["ids"], existing["metadatas"]):
+        entry = state.setdefault(str(metadata.get("article_id")), {
+            "updated_at": metadata.get("updated_at"),
+            "content_hash": metadata.get("content_hash"),
+            "chunk_ids": [],
+        })
+        entry["chunk_ids"].append(doc_id)
+    return state
+
+def classify_record(record, indexed_state):
+    """Returns "added", "updated" or "unchanged" for a record compared to the indexed state."""
+    indexed = indexed_state.get(str(record.get("id")))
+    if indexed is None:
+        return "added"
+    if (indexed["updated_at"] != clean_value(record.get("updated_at"))
+            or indexed["content_hash"] != content_hash(record)):
+        return "updated"
+    return "unchanged"
+
+def prepare_record(record, indexed_state, stripped_content=None):
+    """Builds a changed record's chunk documents and lists the old chunk ids they make stale.
+
+    Old chunks the new version no longer has are stale, or all of them if it lost its body.
+    """
+    documents = build_documents(record, stripped_content)
+    old_ids = indexed_state.get(str(record.get("id")), {}).get("chunk_ids", [])
+    new_ids = {chunk_id(doc.metadata) for doc in documents}
+    return documents, [doc_id for doc_id in old_ids if doc_id not in new_ids]
+
+def upsert_documents(store, documents, embeddings):
+    store._collection.upsert(
+        ids=[chunk_id(doc.metadata) for doc in documents],
+        embeddings=embeddings,
+        metadatas=[doc.metadata for doc in documents],
+        documents=[doc.page_content for doc in documents],
+    )
+    if bm25_index is not None:
+        for doc in documents:
+            bm25_index.add(chunk_id(doc.metadata), doc.page_content, doc.metadata)
+
+def delete_documents(store, ids):
+    store.delete(ids=ids)
+    if bm25_index is not None:
+        for doc_id in ids:
+            bm25_index.remove(doc_id)
+
+def get_bm25_index(store):
+    """Returns the keyword index, building it from the collection the first time.
+
+    Once built it is kept in sync by upsert_documents and delete_documents.
+    """
+    global bm25_index
+    if bm25_index is None:
+        existing = store.get(include=["documents", "metadatas"])
+        index = BM25Index()
+        for doc_id, text, metadata in zip(existing["ids"], existing["documents"], existing["metadatas"]):
+            index.add(doc_id, text, metadata)
+        bm25_index = index
+        logging.info(f"Built BM25 index over {len(index)} chunks.")
+    return bm25_index
+
+def export_embeddings(store, path):
+    """Writes every vector in the collection to a float32 .npy matrix plus an id sidecar.
+
+    Row i of the matrix belongs to ids[i] in `<path>.ids.json`. Both files are written
+    to temporary names and moved into place, so readers never see a partial export.
+    Load them zero-copy with load_embedding_export.
+    """
+    existing = store.get(include=["embeddings"])
+    ids = existing["ids"]
+    if not ids:
+        logging.warning("Collection is empty, skipping embedding export.")
+        return
+    vectors = np.asarray(existing["embeddings"], dtype=np.float32)
 
-async def rebuild_vectorstore(json_file_path, prompt_template, embedding_log_file):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    matrix = np.lib.format.open_memmap(f"{path}.tmp", mode='w+', dtype=np.float32, shape=vectors.shape)
+    matrix[:] = vectors
+    matrix.flush()
+    del matrix
+    with open(f"{path}.ids.json.tmp", 'w') as f:
+        json.dump({"dtype": "float32", "rows": vectors.shape[0], "dim": vectors.shape[1], "ids": ids}, f,
+                  separators=(',', ':'))
+    os.replace(f"{path}.tmp", path)
+    os.replace(f"{path}.ids.json.tmp", f"{path}.ids.json")
+    logging.info(f"Exported {vectors.shape[0]} embeddings to {path}")
+
+def load_embedding_export(path):
+    """Returns (ids, matrix) for an export, with the matrix memory-mapped read-only."""
+    with open(f"{path}.ids.json", 'r') as f:
+        sidecar = json.load(f)
+    return sidecar["ids"], np.load(path, mmap_mode='r')
+
+def log_rebuild_counts(added, updated, deleted, unchanged):
+    logging.info(f"Total records added: {added}, updated: {updated}, deleted: {deleted}, unchanged: {unchanged}")
+    for change, count in (("added", added), ("updated", updated), ("deleted", deleted), ("unchanged", unchanged)):
+        metrics.REBUILD_RECORDS.set(count, change=change)
+
+def get_flat_index(store):
+    """Returns a flat index matching the collection, re-snapshotting it whenever the content changed.
+
+    On startup an existing snapshot is reused if it holds the same chunks at the same content hashes.
+    """
+    with flat_index_lock:
+        return refresh_flat_index(store)
+
+def refresh_flat_index(store):
+    global flat_index, flat_index_version
+    version = index_version  # Read first, so a change landing mid-snapshot still triggers another refresh
+    if flat_index is not None and flat_index_version == version:
+        return flat_index
+    index = None
+    if flat_index is None and os.path.exists(FLAT_INDEX_PATH):
+        try:
+            index = FlatIndex.load(FLAT_INDEX_PATH)
+            existing = store.get(include=["metadatas"])
+            if (sorted(zip(index.ids, (m.get("content_hash") for m in index.metadatas)))
+                    != sorted(zip(existing["ids"], (m.get("content_hash") for m in existing["metadatas"])))):
+                index = None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not load flat index {FLAT_INDEX_PATH}: {str(e)}")
+    if index is None:
+        index = FlatIndex.from_store(store, FLAT_INDEX_PATH)
+    flat_index, flat_index_version = index, version
+    return flat_index
+
+def vector_retriever(store, k):
+    if RETRIEVER_BACKEND == "flat":
+        get_flat_index(store)  # Build or load the snapshot now rather than on the first query
+        return FlatRetriever(index_source=lambda: get_flat_index(store), embedder=get_embedder(), k=k)
+    return store.as_retriever(search_type="similarity", search_kwargs={"k": k})
+
+def bump_index_version():
+    global index_version
+    index_version += 1
+
+def ensure_vectorstore():
+    """Opens the persisted collection on first use."""
+    global vectorstore, bm25_index
+    if vectorstore is None:
+        vectorstore = open_vectorstore()
+        bm25_index = None
+    return vectorstore
+
+def get_record_state(store, article_id):
+    """Same shape as get_indexed_state, for a single article."""
+    existing = store.get(where={"article_id": str(article_id)}, include=["metadatas"])
+    if not existing["ids"]:
+        return {}
+    metadata = existing["metadatas"][0]
+    return {str(article_id): {
+        "updated_at": metadata.get("updated_at"),
+        "content_hash": metadata.get("content_hash"),
+        "chunk_ids": existing["ids"],
+    }}
+
+async def upsert_record(record):
+    """Embeds one record and upserts it into the live collection, replacing any older version.
+
+    The keyword index follows along, and the index version is bumped so cached answers and the
+    flat index snapshot are refreshed. Returns the number of chunks written.
+    """
+    loop = asyncio.get_running_loop()
+    store = vectorstore
+    record_state = await loop.run_in_executor(None, get_record_state, store, record["id"])
+    documents, stale_ids = prepare_record(record, record_state)
+    if documents:
+        embeddings = await embed_texts([doc.page_content for doc in documents])
+        await loop.run_in_executor(None, upsert_documents, store, documents, embeddings)
+    if stale_ids:
+        await loop.run_in_executor(None, delete_documents, store, stale_ids)
+    bump_index_version()
+    if RETRIEVER_BACKEND == "flat":
+        await loop.run_in_executor(None, get_flat_index, store)
+    logging.info(f"Upserted record {record['id']} as {len(documents)} chunks")
+    return len(documents)
+
+async def delete_record(article_id):
+    """Removes every chunk of one record from the live collection. Returns the number removed."""
+    loop = asyncio.get_running_loop()
+    store = vectorstore
+    record_state = await loop.run_in_executor(None, get_record_state, store, article_id)
+    chunk_ids = record_state.get(str(article_id), {}).get("chunk_ids", [])
+    if chunk_ids:
+        await loop.run_in_executor(None, delete_documents, store, chunk_ids)
+        bump_index_version()
+        if RETRIEVER_BACKEND == "flat":
+            await loop.run_in_executor(None, get_flat_index, store)
+    return len(chunk_ids)
+
+def build_qa_chain(store, prompt_template):
+    """Builds a QA chain over store. Blocks while the keyword index and any flat snapshot are
+    loaded from the whole collection, so call it from an executor when on the event loop."""
+    if RETRIEVER_MODE == "hybrid":
+        return assemble_qa_chain(vector_retriever(store, HYBRID_CANDIDATES), prompt_template, get_bm25_index(store))
+    return assemble_qa_chain(vector_retriever(store, RETRIEVAL_K), prompt_template)
+
+def snapshot_qa_chain(index, prompt_template):
+    """Builds a QA chain over a FlatIndex snapshot alone, for HTTP workers that never open the collection."""
+    bm25 = None
+    if RETRIEVER_MODE == "hybrid":
+        bm25 = BM25Index()
+        for doc_id, text, metadata in zip(index.ids, index.documents, index.metadatas):
+            bm25.add(doc_id, text, metadata)
+    k = HYBRID_CANDIDATES if RETRIEVER_MODE == "hybrid" else RETRIEVAL_K
+    return assemble_qa_chain(FlatRetriever(index_source=lambda: index, embedder=get_embedder(), k=k),
+                             prompt_template, bm25)
+
+def assemble_qa_chain(base_retriever, prompt_template, keyword_index=None):
+    """Wraps a vector retriever, fused with keyword_index if given, into the RetrievalQA chain."""
     QA_CHAIN_PROMPT = PromptTemplate(
         input_variables=["context", "question"],
         template=prompt_template,
     )
+    retriever = base_retriever
+    if keyword_index is not None:
+        retriever = HybridRetriever(
+            vector_retriever=base_retriever,
+            bm25_index=keyword_index,
+            k=RETRIEVAL_K,
+            candidates=HYBRID_CANDIDATES,
+            rrf_k=RRF_K,
+        )
+    if CONTEXT_TOKEN_BUDGET > 0:
+        retriever = TokenBudgetRetriever(retriever=retriever, max_tokens=CONTEXT_TOKEN_BUDGET)
+    return RetrievalQA.from_chain_type(
+        llm=llm,
+        chain_type="stuff",
+        retriever=retriever,
+        chain_type_kwargs={"prompt": QA_CHAIN_PROMPT, "document_variable_name": "context"}
+    )
 
-    try:
-        with open(json_file_path, 'r') as f:
-            data = json.load(f)
-
-        logging.info(f"Total records received from remote: {len(data)}")
-
-        # Load supplemental info if available
-        supplemental_file_path = 'supplemental_info.json'
-        if os.path.exists(supplemental_file_path) and os.path.getsize(supplemental_file_path) > 0:
-            with open(supplemental_file_path, 'r') as f:
-                supplemental_data = json.load(f)
-                logging.info(f"Total records received from supplemental: {len(supplemental_data)}")
-                # Convert supplemental data to the format expected by the vector store
-                for item in supplemental_data:
-                    data.append({
-                        "id": f"supplemental_{int(time.time())}",
-                        "type": "article",
-                        "workspace_id": "supplemental",
-                        "parent_id": None,
-                        "parent_type": None,
-                        "parent_ids": [],
-                        "title": item["question"],
-                        "description": item["question"],
-                        "body": item["answer"],
-                        "author_id": None,
-                        "state": "published",
-                        "created_at": int(time.time()),
-                        "updated_at": int(time.time()),
-                        "url": None
-                    })
-
-        # Ensure the data is a list of dictionaries
-        if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
-            raise ValueError(f"Expected a list of dictionaries, but got {type(data)} with content {data}")
-
-        valid_documents = []
-        invalid_documents = []
-        for d in data:
-            if d.get("body") and d["body"].strip():
-                stripped_content = strip_html(d["body"])
-                if stripped_content.strip():
-                    page_content_with_id = f"ID: {d.get('id')}\n{stripped_content}"
-                    metadata = clean_metadata(d)
-                    valid_documents.append(Document(page_content=page_content_with_id, metadata=metadata))
-                else:
-                    invalid_documents.append(d)
-            else:
-                invalid_documents.append(d)
-
-        logging.info(f"Total valid documents: {len(valid_documents)}")
-        logging.info(f"Total invalid documents: {len(invalid_documents)}")
-        for invalid in invalid_documents:
-            logging.warning(f"Invalid document: {invalid}")
-
-        if valid_documents:
-            embedder = CustomGPT4AllEmbeddings(model="all-MiniLM-L6-v2.gguf")
-            logging.info("Generating embeddings for documents...")
-            embeddings = embedder.embed_documents([doc.page_content for doc in valid_documents])
-
-            with open(embedding_log_file, 'w') as f:
-                for doc, embedding in zip(valid_documents, embeddings):
-                    f.write(f"Document ID: {doc.metadata['id']}\n")
-                    f.write(f"Document Content: {doc.page_content}\n")
-                    f.write(f"Embedding: {embedding}\n\n")
-
-            logging.info(f"Total embeddings generated: {len(embeddings)}")
-            vectorstore = Chroma.from_documents(documents=valid_documents, embedding=embedder)
-            logging.info("Vector store successfully rebuilt.")
-
-            retriever = vectorstore.as_retriever(search_type="similarity", k=5)
-            qa_chain = RetrievalQA.from_chain_type(
-                llm=llm,
-                chain_type="stuff",
-                retriever=retriever,
-                chain_type_kwargs={"prompt": QA_CHAIN_PROMPT, "document_variable_name": "context"}
-            )
-            logging.info("QA chain initialized successfully.")
-        else:
-            logging.error("No valid documents with non-empty body found.")
-    except Exception as e:
-        logging.error(f"Error rebuilding vector store: {str(e)}", exc_info=True)
-        raise
-
-    return qa_chain
@@ -1,30 +1,293 @@
 # web_server.py
+import asyncio
+import hmac
+import json
+import os
+import uuid
+import aiohttp
 from quart import Quart, jsonify, request
 from hypercorn.config import Config
 from hypercorn.asyncio import serve
 import logging
+import metrics
+import vector_store
+from query_scheduler import PRIORITY_INTERCOM, SchedulerBusy
+from supplemental_store import ID_PREFIX as SUPPLEMENTAL_ID_PREFIX, SupplementalStore
+import telegram_bot
+from telegram_bot import handle_query, query_coalescer
+
+# Seconds clients are told to wait before retrying when the query queue is full
+BUSY_RETRY_AFTER = 5
+HTTP_PORT = 5001
+# With HTTP_WORKERS > 1 the workers take HTTP_PORT and the main process serves the app here for them
+PRIMARY_PORT = int(os.getenv('PRIMARY_PORT', '5002'))
+# Routes an HTTP worker answers itself; it forwards the rest to the main process. /readyz is
+# answered locally only while the worker has no snapshot loaded.
+WORKER_ROUTES = {'/intercom', '/intercom/stream', '/healthz'}
+# Shared secret the admin bot sends to change supplemental entries; the routes refuse everyone when unset.
+# Port 5001 is published through ngrok, and ngrok connects from localhost, so the client address proves nothing.
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN')
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+# A slot lent to an HTTP worker is taken back after this long, in case the worker died mid-query
+SLOT_LEASE_SECONDS = 600
 
 app = Quart(__name__)
+rebuild_manager = None
+startup_tracker = None
+supplemental_store = SupplementalStore()
+primary_url = None  # Set in HTTP worker processes only
+serving_workers = False  # Set in the main process when HTTP workers share its scheduler and metrics
+slot_leases = {}  # lease id -> timer handle that takes the slot back if the worker never does
+
+@app.before_request
+async def forward_to_primary():
+    """In an HTTP worker, proxies rebuild and supplemental requests to the process that owns the index."""
+    if primary_url is None or request.path in WORKER_ROUTES:
+        return None
+    if request.path.startswith('/internal/'):
+        return jsonify({"error": "Not found"}), 404
+    if request.path == '/readyz' and telegram_bot.qa_chain is None:
+        return None  # Not ready whatever the main process says
+    url = f"{primary_url}{request.path}"
+    if request.query_string:
+        url += f"?{request.query_string.decode()}"
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+            headers = {"Content-Type": request.content_type or "application/json"}
+            if ADMIN_TOKEN_HEADER in request.headers:
+                headers[ADMIN_TOKEN_HEADER] = request.headers[ADMIN_TOKEN_HEADER]
+            async with session.request(request.method, url, data=await request.get_data(), headers=headers) as response:
+                return await response.read(), response.status, {"Content-Type": response.content_type}
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Could not forward {request.method} {request.path} to the main process: {str(e)}")
+        return jsonify({"error": "Main process unavailable"}), 502
+
+def query_sender(data):
+    """Groups requests by Intercom conversation when given, else by client address, for fair scheduling."""
+    return f"intercom:{data.get('conversation_id') or request.remote_addr}"
+
+def admin_denied():
+    """Returns an error response unless the request carries ADMIN_API_TOKEN, else None."""
+    if not ADMIN_API_TOKEN:
+        return jsonify({"error": "Set ADMIN_API_TOKEN to enable this route"}), 403
+    if not hmac.compare_digest(request.headers.get(ADMIN_TOKEN_HEADER, ''), ADMIN_API_TOKEN):
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
+async def is_supplemental_entry(supplemental_id):
+    """True if supplemental_id names an existing supplemental entry, never an Intercom article."""
+    if not supplemental_id.startswith(SUPPLEMENTAL_ID_PREFIX):
+        return False
+    entries = await asyncio.get_running_loop().run_in_executor(None, supplemental_store.load)
+    return supplemental_id in entries
+
+def busy_response(result):
+    """503 for a query that was turned away, because the queue was full or the index is still loading."""
+    body = {"error": result["response"], "busy": bool(result.get("busy")), "warming_up": bool(result.get("warming_up"))}
+    return jsonify(body), 503, {"Retry-After": str(BUSY_RETRY_AFTER)}
 
 @app.route('/intercom', methods=['POST'])
 async def intercom_handler():
     data = await request.get_json()
     query = data.get("body")
     if query:
-        result = await handle_query(query)
+        result = await handle_query(query, priority=PRIORITY_INTERCOM, sender=query_sender(data))
+        if result.get("busy") or result.get("warming_up"):
+            return busy_response(result)
         response = result["response"]
         time_taken = result["time_taken"]
-        return jsonify({"response": response, "time_taken": time_taken}), 200
+        return jsonify({
+            "response": response,
+            "time_taken": time_taken,
+            "time_to_first_token": result.get("time_to_first_token", time_taken),
+            "cached": result.get("cached", False),
+            "coalesced": result.get("coalesced", False)
+        }), 200
     else:
         logging.error("No query provided in the request")
         return jsonify({"error": "No query provided"}), 400
 
+@app.route('/intercom/stream', methods=['POST'])
+async def intercom_stream_handler():
+    """Same as /intercom, but streams the answer as server-sent events.
+
+    Each token arrives as a `data: {"token": ...}` event, followed by a final `done` event
+    carrying the same JSON body /intercom returns.
+    """
+    data = await request.get_json()
+    query = data.get("body")
+    if not query:
+        logging.error("No query provided in the request")
+        return jsonify({"error": "No query provided"}), 400
+    if telegram_bot.qa_chain is None:
+        return busy_response({"response": telegram_bot.WARMING_UP_RESPONSE, "warming_up": True})
+    # A query that will just follow an identical in-flight one doesn't need a scheduler slot
+    if (telegram_bot.query_scheduler.is_full(PRIORITY_INTERCOM)
+            and query_coalescer.get(query, vector_store.index_version) is None):
+        return busy_response({"response": telegram_bot.BUSY_RESPONSE, "busy": True})
+
+    queue = asyncio.Queue()
+    sender = query_sender(data)
+
+    async def run_query():
+        try:
+            result = await handle_query(query, on_token=queue.put_nowait, priority=PRIORITY_INTERCOM, sender=sender)
+        except Exception as e:
+            logging.error(f"Error streaming query: {str(e)}", exc_info=True)
+            result = {"response": "An error occurred while processing the query.", "time_taken": 0}
+        queue.put_nowait(result)
+
+    query_task = asyncio.create_task(run_query())
+
+    async def events():
+        while True:
+            item = await queue.get()
+            if isinstance(item, dict):
+                body = {
+                    "response": item["response"],
+                    "time_taken": item["time_taken"],
+                    "time_to_first_token": item.get("time_to_first_token", item["time_taken"])
+                }
+                if item.get("busy"):
+                    body["busy"] = True
+                yield f"event: done\ndata: {json.dumps(body)}\n\n"
+                break
+            yield f"data: {json.dumps({'token': item})}\n\n"
+        await query_task
+
+    return events(), 200, {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+
 @app.route('/rebuild_vectorstore', methods=['POST'])
 async def rebuild_vectorstore_handler():
-    await rebuild_vectorstore()
-    return jsonify({"message": "Vector store rebuilt"}), 200
+    if rebuild_manager is None:
+        return jsonify({"error": "Rebuilds are not available"}), 503
+    started = rebuild_manager.request()
+    message = "Vector store rebuild started" if started else "Rebuild already running, a follow-up rebuild is queued"
+    return jsonify({"message": message, "status": rebuild_manager.status}), 202
+
+@app.route('/rebuild_status', methods=['GET'])
+async def rebuild_status_handler():
+    if rebuild_manager is None:
+        return jsonify({"error": "Rebuilds are not available"}), 503
+    return jsonify(rebuild_manager.status), 200
+
+@app.route('/supplemental', methods=['POST'])
+async def supplemental_handler():
+    """Adds or edits a supplemental Q&A entry and makes it searchable straight away.
+
+    Takes {"question", "answer"} and optionally the "id" of an existing entry to edit, and
+    needs the ADMIN_API_TOKEN header. The entry is appended to the supplemental store first,
+    so it survives even if indexing fails.
+    """
+    denied = admin_denied()
+    if denied:
+        return denied
+    data = await request.get_json()
+    question = (data or {}).get("question", "").strip()
+    answer = (data or {}).get("answer", "").strip()
+    if not question or not answer:
+        return jsonify({"error": "Both question and answer are required"}), 400
+    if data.get("id") is not None and not await is_supplemental_entry(str(data["id"])):
+        return jsonify({"error": f"No supplemental entry with id {data['id']}"}), 404
+
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    entry = await loop.run_in_executor(None, supplemental_store.put, question, answer, data.get("id"))
+    if vector_store.vectorstore is None:
+        return jsonify({"id": entry["id"], "indexed": False,
+                        "message": "Saved, it will be indexed once the knowledge base has loaded"}), 202
+    try:
+        chunks = await vector_store.upsert_record(vector_store.supplemental_record(entry))
+    except Exception as e:
+        logging.error(f"Error indexing supplemental entry {entry['id']}: {str(e)}", exc_info=True)
+        return jsonify({"id": entry["id"], "indexed": False,
+                        "message": "Saved, but indexing failed; it will be picked up by the next rebuild"}), 202
+    time_taken = loop.time() - start_time
+    return jsonify({"id": entry["id"], "indexed": True, "chunks": chunks, "time_taken": time_taken}), 200
+
+@app.route('/supplemental/<supplemental_id>', methods=['DELETE'])
+async def supplemental_delete_handler(supplemental_id):
+    denied = admin_denied()
+    if denied:
+        return denied
+    if not await is_supplemental_entry(supplemental_id):
+        return jsonify({"error": f"No supplemental entry with id {supplemental_id}"}), 404
+    await asyncio.get_running_loop().run_in_executor(None, supplemental_store.delete, supplemental_id)
+    removed = 0
+    if vector_store.vectorstore is not None:
+        removed = await vector_store.delete_record(supplemental_id)
+    return jsonify({"id": supplemental_id, "chunks_removed": removed}), 200
+
+@app.route('/healthz', methods=['GET'])
+async def healthz_handler():
+    """Liveness: the process is up and the event loop is responsive."""
+    return jsonify({"status": "ok"}), 200
+
+@app.route('/readyz', methods=['GET'])
+async def readyz_handler():
+    """Readiness: a QA chain is loaded and the model warm-up is over, so queries get real answers."""
+    ready = telegram_bot.qa_chain is not None
+    if startup_tracker is not None and startup_tracker.is_running("ollama"):
+        ready = False
+    body = {"ready": ready}
+    if startup_tracker is not None:
+        body.update(startup_tracker.status())
+    return jsonify(body), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_handler():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route('/internal/slots', methods=['POST'])
+async def acquire_slot_handler():
+    """Lends an HTTP worker a slot in this process's scheduler, waiting for one if need be.
+
+    Takes {"priority", "sender"} and returns {"lease", "waited"}, or 503 if the query is
+    turned away. The worker hands the slot back with DELETE /internal/slots/<lease>.
+    """
+    if not serving_workers:
+        return jsonify({"error": "Not found"}), 404
+    data = await request.get_json()
+    try:
+        waited = await telegram_bot.query_scheduler.acquire(data["priority"], data["sender"])
+    except SchedulerBusy as e:
+        return jsonify({"error": str(e)}), 503
+    lease = uuid.uuid4().hex
+    slot_leases[lease] = asyncio.get_running_loop().call_later(SLOT_LEASE_SECONDS, expire_slot_lease, lease)
+    return jsonify({"lease": lease, "waited": waited}), 200
+
+def expire_slot_lease(lease):
+    if slot_leases.pop(lease, None) is not None:
+        logging.warning(f"Slot {lease} was not handed back within {SLOT_LEASE_SECONDS}s, taking it back")
+        telegram_bot.query_scheduler.release()
+
+@app.route('/internal/slots/<lease>', methods=['DELETE'])
+async def release_slot_handler(lease):
+    if not serving_workers:
+        return jsonify({"error": "Not found"}), 404
+    timer = slot_leases.pop(lease, None)
+    if timer is not None:
+        timer.cancel()
+        telegram_bot.query_scheduler.release()
+    return jsonify({"released": timer is not None}), 200
+
+@app.route('/internal/metrics', methods=['POST'])
+async def push_metrics_handler():
+    """Takes an HTTP worker's counters and histograms so /metrics reports totals across processes."""
+    if not serving_workers:
+        return jsonify({"error": "Not found"}), 404
+    data = await request.get_json()
+    metrics.merge_remote(str(data["source"]), data["samples"])
+    return "", 204
 
-async def run_server():
+async def run_server(rebuild_manager_instance=None, startup_tracker_instance=None, bind=f"0.0.0.0:{HTTP_PORT}",
+                     serve_workers=False):
+    """Serves the app. With serve_workers, also lends the HTTP workers scheduler slots and takes
+    their metrics; only pass it when binding to a local address."""
+    global rebuild_manager, startup_tracker, serving_workers
+    rebuild_manager = rebuild_manager_instance
+    startup_tracker = startup_tracker_instance
+    serving_workers = serve_workers
     config = Config()
-    config.bind = ["0.0.0.0:5001"]
+    config.bind = [bind]
     await serve(app, config)
\ No newline at end of file